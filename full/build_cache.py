@@ -0,0 +1,100 @@
+"""Build cache module of the VM translator
+
+Classes:
+    BuildCache
+
+Functions:
+    translator_version() -> str
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+
+from linker import Fragment
+
+
+CACHE_DIR = '.vmcache'
+
+
+@lru_cache(maxsize=None)
+def translator_version():
+    """Return a digest of the translator's own source code,
+    so that cached fragments are invalidated whenever the translator changes.
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            with open(os.path.join(directory, name), 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """On-disk cache of translated fragments.
+
+    Each fragment is stored in its own file, keyed by a hash of
+    the translator version, the translation options, the source name,
+    and the source content. Entries are written to a temporary file
+    and atomically renamed into place, so concurrent builds sharing
+    a cache never observe a partially written entry.
+
+    Properties:
+        directory: directory the cache entries are stored in
+        hits: number of fragments found in the cache
+        misses: number of fragments that had to be translated
+
+    Methods:
+        key(str, bytes) -> str
+        load(str) -> Fragment or None
+        store(str, Fragment) -> None
+    """
+
+    def __init__(self, directory, options):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._salt = f'{translator_version()}\n{sorted(options.items())}\n'.encode()
+
+
+    def key(self, name, content):
+        """Return the cache key of a source file with the given name and content"""
+        digest = hashlib.sha256(self._salt)
+        digest.update(name.encode() + b'\n')
+        digest.update(content)
+        return digest.hexdigest()
+
+
+    def load(self, key):
+        """Return the cached fragment stored under the given key, or None"""
+        try:
+            with open(self._path(key), 'r') as file:
+                entry = json.load(file)
+            fragment = Fragment.from_dict(entry)
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, or unreadable entry: translate again and overwrite it
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return fragment
+
+
+    def store(self, key, fragment):
+        """Store a fragment under the given key"""
+        os.makedirs(self.directory, exist_ok=True)
+        file = tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with file:
+                json.dump(fragment.to_dict(), file)
+            os.replace(file.name, self._path(key))
+        except BaseException:
+            os.unlink(file.name)
+            raise
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
@@ -1,10 +1,57 @@
 """Code writer module of the VM translator
 
 Classes:
+    TemplateCache
     CodeWriter
 """
 
+from collections import Counter, OrderedDict
+
 from constants import *
+from fusion import BINARY_OPERATORS, COMPARISON_JUMPS, NEGATED_COMPARISON_JUMPS, find_fusions
+from output import BufferedOutput
+from peephole import PeepholeOptimizer
+
+
+class TemplateCache:
+    """Bounded cache of rendered assembly fragments,
+    evicting the least recently used fragment when full.
+
+    Properties:
+        max_size: maximum number of fragments kept
+        hits: number of lookups that found a fragment
+        misses: number of lookups that did not
+
+    Methods:
+        get(hashable) -> str or None
+        put(hashable, str) -> str
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+
+
+    def get(self, key):
+        """Return the fragment stored under the given key, or None"""
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._fragments.move_to_end(key)
+        return fragment
+
+
+    def put(self, key, fragment):
+        """Store a fragment under the given key and return it"""
+        self._fragments[key] = fragment
+        if len(self._fragments) > self.max_size:
+            self._fragments.popitem(last=False)
+        return fragment
+
 
 class CodeWriter:
     """CodeWriter class of the Hack VM Translator.
@@ -12,10 +59,38 @@ class CodeWriter:
     Translates a parsed VM command into Hack assembly code.
 
     Properties:
-        file: file object of the output file
+        output: output backend the assembly code is written to,
+            created for the output file when given a filename
+        comments: whether each command is preceded by a comment
+        class_sources: whether the source name is taken from the class
+            of each function, for VM code that is not split into files
+        shared_calls: whether calls and returns jump to shared routines,
+            instead of inlining the frame handling at every site
+        comparisons: how eq, gt, and lt are translated: 'inline',
+            'shared' to jump to a shared routine per comparison,
+            or 'auto' to share only the routines that make each program smaller
+        shared_comparisons: set of the comparisons currently jumping to a shared routine
+        runtime: set of the names of the shared routines the code needs
+        stats: Counter of the translation statistics
+        template_cache: TemplateCache of the rendered push, pop,
+            and arithmetic instructions
+        peephole: window size of the peephole optimizer the output
+            is passed through, or 0 to write the code unoptimized
+        fusion: whether common sequences of commands are translated together,
+            keeping intermediate values in registers instead of on the stack
+        tos_cache: whether the topmost stack value is kept in D within straight-line
+            code, and only stored to the stack before branching, calling, or returning
+        virtual_sp: whether stack slots are addressed relative to SP within straight-line
+            code, and SP is only updated before branching, calling, or returning
+        prologue_threshold: largest number of local variables a function zeroes
+            with a store per variable, instead of with a loop
+        reduced_frames: set of the names of the functions called with a reduced frame,
+            that does not save THIS and THAT, taken from each program written
 
     Methods:
         set_filename(str) -> None
+        write_program(Program) -> None
+        write_fragment(str) -> None
         write_arithmetic(str) -> None
         write_push_pop(str, str, int) -> None
         write_label(str) -> None
@@ -24,15 +99,50 @@ class CodeWriter:
         write_function(str, int) -> None
         write_return() -> None
         write_call() -> None
+        write_tail_call(str, int) -> None
+        write_fusion(Fusion, Program, int) -> None
+        write_runtime(set) -> None
+        flush() -> None
+        close() -> None
     """
 
-    def __init__(self, filename):
-        self.file = open(filename, 'w')
-        self.unique_num = 0  # for making each symbolic label globally unique
+    def __init__(self, output, cache_size=4096, comments=True, bootstrap=True,
+                 class_sources=False, shared_calls=False, comparisons='inline', peephole=0,
+                 fusion=False, tos_cache=False, virtual_sp=False, prologue_threshold=8):
+        self.stats = Counter()
+        if isinstance(output, str):
+            output = BufferedOutput(open(output, 'w'))
+        self._fragment_output = output
+        if peephole:
+            output = PeepholeOptimizer(output, peephole, stats=self.stats)
+        self.output = output
+        self.comments = comments
+        self.peephole = peephole
+        self.fusion = fusion
+        self.tos_cache = tos_cache
+        self.virtual_sp = virtual_sp
+        self.prologue_threshold = prologue_threshold
+        self._tos_in_d = False  # whether the topmost stack value is in D, instead of on the stack
+        self._sp_offset = 0  # number of values pushed, less popped, not yet counted in SP: 0 or 1
+        self._function = None  # name of the function being translated
+        self.reduced_frames = frozenset()
+        self.unique_num = 0  # for making each symbolic label unique within the source
         self.source = ''
         self.function_calls = {}  # ex: {"function_name": num_calls}
-
-        self._write_bootstrap_code()
+        self.class_sources = class_sources
+        self.shared_calls = shared_calls
+        self.comparisons = comparisons
+        self.shared_comparisons = set(COMPARISON_COMMANDS) if comparisons == 'shared' else set()
+        self.runtime = set()  # names of the shared routines the code jumps to
+        self.template_cache = TemplateCache(cache_size)
+        self._label_counters = {}
+        self._comparison_words_saved = (
+            self._count_words(self._generate_arithmetic_instructions('eq', 0))
+            - self._count_words(self._generate_shared_comparison_instructions('eq', 0))
+        )
+
+        if bootstrap:
+            self._write_bootstrap_code()
 
 
     def _write_bootstrap_code(self):
@@ -45,14 +155,96 @@ class CodeWriter:
         # set stack pointer to 256
         self._write_instructions(instructions)
         # call Sys.init
-        self.write_call('Sys.init', 0)
+        self.set_filename('bootstrap')
+        self.write_call(ENTRY_FUNCTION, 0)
 
 
     def set_filename(self, filename):
         """Inform that the translation of a new VM file has started.
         Set the name of the current source file being translated.
+        Generated labels are scoped to the source file,
+        so each file translates independently of the others.
         """
+        # keep the label counters of each source, in case it is resumed later
+        self._label_counters[self.source] = self.unique_num, self.function_calls
         self.source = filename.split('/')[-1]
+        self.unique_num, self.function_calls = self._label_counters.get(self.source, (0, {}))
+
+
+    def write_program(self, program):
+        """Write to the output file,
+        the assembly code of every command in the given program.
+        """
+        handlers = self._dispatch_table(program.symbols.names)
+        self.reduced_frames = program.reduced_frames
+        fusions = find_fusions(program) if self.fusion else {}
+
+        # share the code of each comparison only if that makes the program smaller,
+        # not counting the comparisons fused with a branch, which never use it
+        if self.comparisons == 'auto':
+            routine_words = self._count_words(self._generate_comparison_routine('eq'))
+            fused = Counter(program.opcodes[index] for index in fusions)
+            self.shared_comparisons = {
+                command for command in COMPARISON_COMMANDS
+                if (program.opcodes.count(OPCODES[command]) - fused[OPCODES[command]])
+                * self._comparison_words_saved > routine_words
+            }
+
+        if not fusions:
+            for opcode, arg1, arg2 in program:
+                handlers[opcode](arg1, arg2)
+        else:
+            self._write_fused_program(program, fusions, handlers)
+
+        # leave the stack in memory for whatever code follows
+        if self._tos_in_d or self._sp_offset:
+            self._write_instructions(self._flush_stack())
+
+
+    def _write_fused_program(self, program, fusions, handlers):
+        index = 0
+        while index < len(program):
+            fusion = fusions.get(index)
+            if fusion:
+                self.write_fusion(fusion, program, index)
+                index += len(fusion)
+            else:
+                opcode, arg1, arg2 = program[index]
+                handlers[opcode](arg1, arg2)
+                index += 1
+
+
+    def _dispatch_table(self, names):
+        # handler of each opcode, decoding its operands for the write method
+        handlers = [
+            lambda arg1, arg2, command=command: self.write_arithmetic(command)
+            for command in ARITHMETIC_COMMANDS
+        ]
+        handlers += [
+            # memory access commands
+            lambda arg1, arg2: self.write_push_pop(C_PUSH, SEGMENTS[arg1], arg2),
+            lambda arg1, arg2: self.write_push_pop(C_POP, SEGMENTS[arg1], arg2),
+            # branching commands
+            lambda arg1, arg2: self.write_label(names[arg1]),
+            lambda arg1, arg2: self.write_goto(names[arg1]),
+            lambda arg1, arg2: self.write_if(names[arg1]),
+            # function commands
+            lambda arg1, arg2: self.write_function(names[arg1], arg2),
+            lambda arg1, arg2: self.write_call(names[arg1], arg2),
+            lambda arg1, arg2: self.write_return(),
+            lambda arg1, arg2: self.write_tail_call(names[arg1], arg2),
+        ]
+        return handlers
+
+
+    def write_fragment(self, fragment):
+        """Write to the output file,
+        a fragment of assembly code translated by another writer.
+        """
+        # fragments were already optimized by their own writer
+        if self.output is not self._fragment_output:
+            self.output.flush()
+        self._fragment_output.write(fragment)
 
 
     def write_arithmetic(self, command):
@@ -60,89 +252,415 @@ class CodeWriter:
         the assembly code that implements the given arithmetic-logic command.
         """
         self._write_comment(command)
-        instructions = self._generate_arithmetic_instructions(command, self.unique_num)
-        self._write_instructions(instructions)
+        shared = command in self.shared_comparisons
+
+        if self.tos_cache and not shared:
+            self._write_instructions(self._generate_cached_arithmetic_instructions(command))
+            return
+        if self.virtual_sp and not shared:
+            self._write_instructions(self._generate_virtual_arithmetic_instructions(command))
+            return
+
+        # comparisons keep a placeholder for their unique label number
+        key = (command, shared)
+        template = self.template_cache.get(key)
+        if template is None:
+            if shared:
+                instructions = self._generate_shared_comparison_instructions(command, '{unique}')
+            else:
+                instructions = self._generate_arithmetic_instructions(command, '{unique}')
+            template = self.template_cache.put(key, '\n'.join(instructions))
+
+        if shared:
+            self.runtime.add(COMPARISON_ROUTINES[command])
+            self.stats['shared comparison sites'] += 1
+            self.stats['shared comparison words saved'] += self._comparison_words_saved
+
+        # the shared routines take their operands from the stack
+        spill = self._flush_stack()
+        if command in COMPARISON_COMMANDS:
+            self._write_instructions(spill + [template.format(unique=self._unique_suffix())])
+        else:
+            self._write_instructions(spill + [template])
+
+
+    def _generate_cached_arithmetic_instructions(self, command):
+        # compute on the topmost value in D, and the value below it on the stack
+        instructions = self._fill_tos()
+
+        if command == 'neg':
+            return instructions + ['D=-D']
+        if command == 'not':
+            return instructions + ['D=!D']
+
+        instructions += self._pop_address()
+        if command == 'add':
+            return instructions + ['D=D+M']
+        if command == 'sub':
+            return instructions + ['D=M-D']
+        if command == 'and':
+            return instructions + ['D=D&M']
+        if command == 'or':
+            return instructions + ['D=D|M']
+
+        return instructions + self._generate_comparison_instructions(command, self._unique_suffix())
+
+
+    def _generate_virtual_arithmetic_instructions(self, command):
+        # compute on the topmost stack values in place, addressed relative to SP
+        if command == 'neg':
+            return self._stack_address(self._sp_offset - 1) + ['M=-M']
+        if command == 'not':
+            return self._stack_address(self._sp_offset - 1) + ['M=!M']
+
+        instructions = self._pop_address() + ['D=M', 'A=A-1']
+        if command == 'add':
+            return instructions + ['M=D+M']
+        if command == 'sub':
+            return instructions + ['M=M-D']
+        if command == 'and':
+            return instructions + ['M=D&M']
+        if command == 'or':
+            return instructions + ['M=D|M']
+
+        return (instructions + self._generate_comparison_instructions(command, self._unique_suffix())
+                + self._stack_address(self._sp_offset - 1) + ['M=D'])
 
 
     def write_push_pop(self, command, segment, index):
         """Write to the output file,
         the assembly code that implements the given push or pop command.
         """
-        # generate common stack operation snippets
-        seg_to_d, d_to_stack, stack_to_d, d_to_seg = \
-            self._generate_push_pop_snippets(segment, index)
-
-        # determine memory segment mapping
-        if segment == 'local':
-            mem_seg = 'LCL'
-        elif segment == 'argument':
-            mem_seg = 'ARG'
-        else:  # this, that, and temp
-            mem_seg = segment.upper()
+        self._write_comment(f'{"push" if command == C_PUSH else "pop"} {segment} {index}')
+
+        if self.tos_cache:
+            if command == C_PUSH:
+                instructions = self._spill_tos() + self._seg_to_d(segment, index)
+                self._tos_in_d = True
+            elif self._tos_in_d:
+                instructions = self._d_to_seg(segment, index)
+                self._tos_in_d = False
+            else:
+                instructions = self._pop_to_seg(segment, index)
+            self._write_instructions(instructions)
+            return
+        if self.virtual_sp:
+            self._write_instructions(self._generate_push_pop_instructions(command, segment, index))
+            return
+
+        # only the static segment depends on the current source
+        key = (command, segment, index, self.source if segment == 'static' else None)
+        fragment = self.template_cache.get(key)
+        if fragment is None:
+            instructions = self._generate_push_pop_instructions(command, segment, index)
+            fragment = self.template_cache.put(key, '\n'.join(instructions))
 
+        self._write_instructions([fragment])
+
+
+    def _unique_suffix(self):
+        """Return the suffix making the labels of the current command unique"""
+        return f'{self.source}.{self.unique_num}'
+
+
+    @staticmethod
+    def _generate_comparison_instructions(command, unique):
+        # compare M with D, leaving true (-1) or false (0) in D
+        op = command.upper()
+        return [
+            'D=M-D',
+            f'@{op}_{unique}',
+            f'D;J{op}',
+            'D=0',
+            f'@FINALIZE_{unique}',
+            '0;JMP',
+            f'({op}_{unique})',
+            'D=-1',
+            f'(FINALIZE_{unique})',
+        ]
+
+
+    @staticmethod
+    def _generate_shared_comparison_instructions(command, unique_num):
+        return [
+            f'@{command.upper()}_{unique_num}',
+            'D=A',
+            '@R15',
+            'M=D',      # pass the return address
+            f'@{COMPARISON_ROUTINES[command]}',
+            '0;JMP',    # let the shared routine compare the two topmost values
+            f'({command.upper()}_{unique_num})'
+        ]
+
+
+    def _generate_push_pop_instructions(self, command, segment, index):
         if command == C_PUSH:
-            self._write_comment(f'push {segment} {index}')
-
-            if segment == 'constant':
-                instructions = [
-                    f'@{index}',
-                    'D=A',
-                    '\n'.join(d_to_stack)
-                ]
-
-            # special case for static segment
-            elif segment == 'static':
-                instructions = [
-                    f'@{self.source}.{index}',
-                    'D=M',
-                    '\n'.join(d_to_stack)
-                ]
-
-            # special case for pointer segment
-            elif segment == 'pointer':
-                instructions = [
-                    '@THIS' if index == 0 else '@THAT',
-                    'D=M',
-                    '\n'.join(d_to_stack)
-                ]
-
-            # local, argument, this, that, and temp
-            else:
-                instructions = [
-                    '\n'.join(seg_to_d).format(seg=mem_seg),
-                    '\n'.join(d_to_stack)
-                ]
+            return self._seg_to_d(segment, index) + self._push_d()
+        return self._pop_to_seg(segment, index)
+
+
+    def write_fusion(self, fusion, program, index):
+        """Write to the output file,
+        the assembly code that implements the commands of the program
+        fused together, starting at the given index.
+        """
+        commands = [program[i] for i in range(index, index + len(fusion))]
+        for i in range(index, index + len(fusion)):
+            self._write_comment(program.format_command(i))
+
+        # the static segment depends on the current source, and branches keep
+        # a placeholder for their label, as symbol ids are only unique within the program
+        key = (fusion.name, tuple(command[:1] if command[0] == OP_IF else command
+                                  for command in commands), self.source)
+        fragment = self.template_cache.get(key)
+        if fragment is None:
+            generate = getattr(self, f'_generate_{fusion.name}_instructions')
+            fragment = self.template_cache.put(key, '\n'.join(generate(*commands)))
+
+        self.stats[f'fusion {fusion.name}'] += 1
+        if commands[-1][0] == OP_IF:
+            fragment = fragment.format(label=program.symbols[commands[-1][1]])
+        # fused code keeps its intermediate values in D
+        flush = self._flush_stack() if fusion.uses_stack else self._spill_tos()
+        self._write_instructions(flush + [fragment])
 
-            self._write_instructions(instructions)
 
-        # pop commands
+    @staticmethod
+    def _compare_branch_instructions(jump):
+        # compare the two topmost values, and jump on the result without pushing it
+        return [
+            '@SP',
+            'AM=M-1',
+            'D=M',
+            '@SP',
+            'AM=M-1',
+            'D=M-D',
+            '@{label}',
+            f'D;{jump}',
+        ]
+
+
+    def _generate_compare_branch_instructions(self, comparison, branch):
+        return self._compare_branch_instructions(COMPARISON_JUMPS[comparison[0]])
+
+
+    def _generate_negated_compare_branch_instructions(self, comparison, negation, branch):
+        return self._compare_branch_instructions(NEGATED_COMPARISON_JUMPS[comparison[0]])
+
+
+    def _generate_binary_move_instructions(self, push_a, push_b, operation, pop):
+        # compute the operation in D, and store it without going through the stack
+        operator = BINARY_OPERATORS[operation[0]]
+        segment_b, index_b = SEGMENTS[push_b[1]], push_b[2]
+
+        if segment_b == 'constant':
+            instructions = self._seg_to_d(SEGMENTS[push_a[1]], push_a[2]) + [
+                f'@{index_b}',
+                f'D=D{operator}A',
+            ]
         else:
-            self._write_comment(f'pop {segment} {index}')
-
-            # special case for static segment
-            if segment == 'static':
-                instructions = [
-                    '\n'.join(stack_to_d),
-                    f'@{self.source}.{index}',
-                    'M=D'
-                ]
-
-            # special case for pointer segment
-            elif segment == 'pointer':
-                instructions = [
-                    '\n'.join(stack_to_d),
-                    '@THIS' if index == 0 else '@THAT',
-                    'M=D'
-                ]
-
-            # local, argument, this, that, and temp
-            else:
-                instructions = [
-                    '\n'.join(stack_to_d),
-                    '\n'.join(d_to_seg).format(seg=mem_seg)
-                ]
+            instructions = self._seg_to_d(segment_b, index_b) + [
+                '@R13',
+                'M=D',      # keep the second operand
+            ] + self._seg_to_d(SEGMENTS[push_a[1]], push_a[2]) + [
+                '@R13',
+                f'D=D{operator}M',
+            ]
+
+        return instructions + self._d_to_seg(SEGMENTS[pop[1]], pop[2])
+
+
+    def _generate_move_instructions(self, push, pop):
+        # copy a value between segments without going through the stack
+        segment, index = SEGMENTS[push[1]], push[2]
+
+        # small constants can be stored directly
+        if segment == 'constant' and index in (0, 1):
+            return self._seg_to_a(SEGMENTS[pop[1]], pop[2]) + [f'M={index}']
+
+        return self._seg_to_d(segment, index) + self._d_to_seg(SEGMENTS[pop[1]], pop[2])
+
+
+    def _generate_constant_operation_instructions(self, push, operation):
+        # apply the operation to the topmost stack value in place
+        operator = BINARY_OPERATORS[operation[0]]
+        constant = push[2]
+
+        if constant == 1 and operator in '+-':
+            return ['@SP', 'A=M-1', f'M=M{operator}1']
+
+        return [
+            f'@{constant}',
+            'D=A',
+            '@SP',
+            'A=M-1',
+            'M=M-D' if operator == '-' else f'M=D{operator}M',
+        ]
+
+
+    def _spill_tos(self):
+        """Return the instructions storing the topmost stack value kept in D
+        back to the stack, if it is kept there.
+        """
+        if not self._tos_in_d:
+            return []
+        self._tos_in_d = False
+        return self._push_d()
+
+
+    def _fill_tos(self):
+        """Return the instructions popping the topmost stack value into D,
+        unless it is kept there already.
+        """
+        if self._tos_in_d:
+            return []
+        self._tos_in_d = True
+        return self._pop_d()
+
+
+    def _flush_stack(self):
+        """Return the instructions leaving the whole stack in memory, with SP up to date,
+        as expected when code is entered from, or left for, elsewhere.
+        """
+        return self._spill_tos() + self._flush_sp()
 
-            self._write_instructions(instructions)
+
+    def _flush_sp(self, keep_d=False):
+        """Return the instructions counting the pending stack offset into SP"""
+        offset = self._sp_offset
+        if not offset:
+            return []
+        self._sp_offset = 0
+
+        if abs(offset) <= 2:
+            return ['@SP'] + [f'M=M{"+" if offset > 0 else "-"}1'] * abs(offset)
+        instructions = [f'@{abs(offset)}', 'D=A', '@SP', 'M=D+M' if offset > 0 else 'M=M-D']
+        if keep_d:
+            instructions = ['@R13', 'M=D'] + instructions + ['@R13', 'D=M']
+        return instructions
+
+
+    def _stack_address(self, offset):
+        """Return the instructions pointing A to the stack slot
+        at the given offset from SP, without using D.
+        """
+        if not offset:
+            return ['@SP', 'A=M']
+        step = '+1' if offset > 0 else '-1'
+        return ['@SP', f'A=M{step}'] + [f'A=A{step}'] * (abs(offset) - 1)
+
+
+    def _push_d(self):
+        """Return the instructions pushing D to the stack"""
+        if not self.virtual_sp:
+            return ['@SP', 'M=M+1', 'A=M-1', 'M=D']
+        if self._sp_offset > 0:
+            # count a pending push into SP, so the offset never grows past 1
+            return ['@SP', 'AM=M+1'] + ['A=A+1'] * (self._sp_offset - 1) + ['M=D']
+        self._sp_offset += 1
+        return self._stack_address(self._sp_offset - 1) + ['M=D']
+
+
+    def _pop_address(self):
+        """Return the instructions popping the topmost stack value,
+        and pointing A to it.
+        """
+        if not self.virtual_sp:
+            return ['@SP', 'AM=M-1']
+        if self._sp_offset < 1:
+            # count the pop into SP, so the offset never drops below 0
+            return ['@SP', 'AM=M-1'] + ['A=A-1'] * -self._sp_offset
+        self._sp_offset -= 1
+        return self._stack_address(self._sp_offset)
+
+
+    def _pop_d(self):
+        """Return the instructions popping the topmost stack value into D"""
+        return self._pop_address() + ['D=M']
+
+
+    def _pop_d_flushed(self):
+        """Return the instructions popping the topmost stack value into D,
+        counting the pending stack offset into SP at the same time.
+        """
+        offset = self._sp_offset - 1
+        self._sp_offset = 0
+        if not offset:
+            return ['@SP', 'A=M', 'D=M']
+        if abs(offset) == 1:
+            return ['@SP', f'AM=M{"+" if offset > 0 else "-"}1', 'D=M']
+        return [f'@{abs(offset)}', 'D=A', '@SP', 'AM=D+M' if offset > 0 else 'AM=M-D', 'D=M']
+
+
+    def _seg_to_a(self, segment, index, keep_d=False):
+        """Return the shortest instructions pointing A to a slot of a memory segment.
+        With keep_d, only instructions leaving D unchanged are considered.
+        """
+        if segment in SEGMENT_POINTERS:
+            pointer = SEGMENT_POINTERS[segment]
+            # follow the pointer, then step to the slot
+            candidates = [[f'@{pointer}', 'A=M+1' if index else 'A=M'] + ['A=A+1'] * (index - 1)]
+            if not keep_d:
+                # add the index to the pointer
+                candidates.append([f'@{pointer}', 'D=M', f'@{index}', 'A=D+A'])
+            return min(candidates, key=len)
+        if segment == 'temp':
+            return [f'@{TEMP_BASE + index}']
+        if segment == 'pointer':
+            return ['@THIS' if index == 0 else '@THAT']
+        return [f'@{self.source}.{index}']
+
+
+    def _seg_address_to_d(self, segment, index):
+        """Return the instructions loading the address of a slot
+        of a memory segment located through a pointer into D.
+        """
+        pointer = SEGMENT_POINTERS[segment]
+        if index <= 1:
+            return [f'@{pointer}', 'D=M+1' if index else 'D=M']
+        return [f'@{index}', 'D=A', f'@{pointer}', 'D=D+M']
+
+
+    def _seg_to_d(self, segment, index):
+        """Return the instructions loading a slot of a memory segment into D"""
+        if segment == 'constant':
+            return [f'D={index}'] if index in (0, 1) else [f'@{index}', 'D=A']
+        return self._seg_to_a(segment, index) + ['D=M']
+
+
+    def _d_to_seg(self, segment, index):
+        """Return the shortest instructions storing D into a slot of a memory segment"""
+        candidates = [self._seg_to_a(segment, index, keep_d=True) + ['M=D']]
+        if segment in SEGMENT_POINTERS:
+            # with the value kept in R13, D = address + value, so A = D - value and M = D - A
+            candidates.append([
+                '@R13',
+                'M=D',
+                f'@{SEGMENT_POINTERS[segment]}',
+                'D=D+M',
+                f'@{index}',
+                'D=D+A',
+                '@R13',
+                'A=D-M',
+                'M=D-A',
+            ])
+        return min(candidates, key=len)
+
+
+    def _pop_to_seg(self, segment, index):
+        """Return the shortest instructions popping the topmost stack value
+        into a slot of a memory segment.
+        """
+        address = self._pop_address()
+        candidates = [address + ['D=M'] + self._d_to_seg(segment, index)]
+        if segment in SEGMENT_POINTERS:
+            # with D = slot address, D = address + value, so A = D - value and M = D - A
+            candidates.append(self._seg_address_to_d(segment, index) + address + [
+                'D=D+M',
+                'A=D-M',
+                'M=D-A',
+            ])
+        return min(candidates, key=len)
 
 
     def write_label(self, label):
@@ -150,7 +668,7 @@ class CodeWriter:
         the assembly code that implements the label command.
         """
         self._write_comment(f'label {label}')
-        instructions = [f'({label})']
+        instructions = self._flush_stack() + [f'({label})']
         self._write_instructions(instructions)
 
 
@@ -159,7 +677,7 @@ class CodeWriter:
         the assembly code that implements the unconditional goto command.
         """
         self._write_comment(f'goto {label}')
-        instructions = [
+        instructions = self._flush_stack() + [
             f'@{label}',
             '0;JMP',
         ]
@@ -171,10 +689,12 @@ class CodeWriter:
         the assembly code that implements the conditional goto command.
         """
         self._write_comment(f'if-goto {label}')
-        instructions = [
-            '@SP',
-            'AM=M-1',
-            'D=M',
+        if self._tos_in_d:
+            instructions = self._flush_sp(keep_d=True)
+        else:
+            instructions = self._pop_d_flushed()
+        self._tos_in_d = False
+        instructions += [
             f'@{label}',
             'D;JNE'
         ]
@@ -185,10 +705,14 @@ class CodeWriter:
         """Write to the output file,
         the assembly code that implements the function command.
         """
+        if self.class_sources:
+            self.set_filename(function.split('.')[0])
+        self._function = function
+
         self._write_comment(f'function {function} {local_variables}')
 
         # create function entry label
-        instructions = [f'({function})']
+        instructions = self._flush_stack() + [f'({function})']
 
         # assign local memory segment
         instructions += [
@@ -199,19 +723,57 @@ class CodeWriter:
         ]
 
         # initialize local variables
-        for _ in range(local_variables):
-            instructions += [
-                '@0',
-                'D=A',
-                '@SP',
-                'M=M+1',
-                'A=M-1',
-                'M=D'
-            ]
+        if local_variables:
+            if local_variables > self.prologue_threshold:
+                initialization = self._generate_local_loop_instructions(function, local_variables)
+            else:
+                initialization = self._generate_local_store_instructions(local_variables)
+            instructions += initialization
+            self.stats['prologues'] += 1
+            self.stats['prologue words saved'] += (
+                6 * local_variables - self._count_words(initialization))
 
         self._write_instructions(instructions)
 
 
+    @staticmethod
+    def _generate_local_store_instructions(local_variables):
+        """Return the instructions zeroing the local variables one store at a time,
+        following the assignment of SP to LCL, which leaves SP in D.
+        """
+        return [
+            'A=D',
+            'M=0',
+            *['A=A+1', 'M=0'] * (local_variables - 1),
+            'D=A+1',
+            '@SP',
+            'M=D'                       # SP = address after the last local
+        ]
+
+
+    @staticmethod
+    def _generate_local_loop_instructions(function, local_variables):
+        """Return the instructions zeroing the local variables in a loop,
+        from the last one down to the first.
+        """
+        loop = f'{function}$$locals'
+        return [
+            f'@{local_variables}',
+            'D=A',
+            f'({loop})',
+            'D=D-1',
+            '@LCL',
+            'A=D+M',
+            'M=0',                      # LCL[D] = 0
+            f'@{loop}',
+            'D;JGT',
+            f'@{local_variables}',
+            'D=A',
+            '@SP',
+            'M=D+M'                     # SP += local_variables
+        ]
+
+
     def write_call(self, function, num_arguments):
         """Write assembly code that effects the call command."""
         self._write_comment(f'call {function} {num_arguments}')
@@ -223,20 +785,39 @@ class CodeWriter:
             self.function_calls[function] = 0
             call_num = 0
 
-        return_address = f'{function}$ret.{call_num}'
+        return_address = f'{function}$ret.{self.source}.{call_num}'
 
-        instructions = [
+        reduced = function in self.reduced_frames
+        pointers = REDUCED_FRAME_POINTERS if reduced else FRAME_POINTERS
+        instructions = self._generate_call_instructions(
+            function, num_arguments, return_address, pointers)
+        if reduced:
+            self._count_reduced_frame('call', self._generate_call_instructions(
+                function, num_arguments, return_address), instructions)
+
+        if self.shared_calls:
+            inline_words = self._count_words(instructions)
+            routine = REDUCED_CALL_ROUTINE if reduced else CALL_ROUTINE
+            instructions = self._generate_shared_call_instructions(
+                function, num_arguments, return_address, routine)
+            self.runtime.add(routine)
+            self.stats['shared call sites'] += 1
+            self.stats['shared call words saved'] += inline_words - self._count_words(instructions)
+
+        self._write_instructions(self._flush_stack() + instructions)
+
+
+    def _generate_call_instructions(self, function, num_arguments, return_address,
+                                    pointers=FRAME_POINTERS):
+        return [
             f'@{return_address}',
             'D=A',
             '@SP',
             'M=M+1',
             'A=M-1',
             'M=D',                      # push return address label to stack
-            self._push_segment('LCL'),
-            self._push_segment('ARG'),
-            self._push_segment('THIS'),
-            self._push_segment('THAT'),
-            f'@{5 + num_arguments}',    # number to subtract from SP to get to ARG
+            *map(self._push_segment, pointers),
+            f'@{len(pointers) + 1 + num_arguments}',    # number to subtract from SP to get to ARG
             'D=A',
             '@SP',
             'D=M-D',
@@ -251,7 +832,33 @@ class CodeWriter:
             f'({return_address})'       # inject return address label into the code
         ]
 
-        self._write_instructions(instructions)
+
+    @staticmethod
+    def _generate_shared_call_instructions(function, num_arguments, return_address,
+                                           routine=CALL_ROUTINE):
+        instructions = [
+            f'@{return_address}',
+            'D=A',
+            '@R13',
+            'M=D',                      # pass the return address
+        ]
+        instructions += CodeWriter._pass_argument_count(num_arguments)
+        instructions += [
+            f'@{function}',
+            'D=A',                      # pass the callee
+            f'@{routine}',
+            '0;JMP',                    # let the shared routine build the frame and call
+            f'({return_address})'
+        ]
+        return instructions
+
+
+    @staticmethod
+    def _pass_argument_count(num_arguments):
+        # pass the number of arguments to a shared routine in R14
+        if num_arguments <= 1:
+            return ['@R14', f'M={num_arguments}']
+        return [f'@{num_arguments}', 'D=A', '@R14', 'M=D']
 
 
     @staticmethod
@@ -273,12 +880,68 @@ class CodeWriter:
         """
         self._write_comment('return')
 
+        reduced = self._function in self.reduced_frames
+        pointers = REDUCED_FRAME_POINTERS if reduced else FRAME_POINTERS
+        instructions = self._generate_return_instructions(pointers)
+        if reduced:
+            self._count_reduced_frame('return', self._generate_return_instructions(), instructions)
+
+        if self.shared_calls:
+            inline_words = self._count_words(instructions)
+            routine = REDUCED_RETURN_ROUTINE if reduced else RETURN_ROUTINE
+            instructions = [
+                f'@{routine}',
+                '0;JMP'     # let the shared routine return to the caller
+            ]
+            self.runtime.add(routine)
+            self.stats['shared return sites'] += 1
+            self.stats['shared call words saved'] += inline_words - self._count_words(instructions)
+
+        self._write_instructions(self._flush_stack() + instructions)
+
+
+    def write_tail_call(self, function, num_arguments):
+        """Write to the output file,
+        the assembly code that implements a call command followed by a return command,
+        by replacing the frame of the current function with the frame of the callee.
+        """
+        reduced = function in self.reduced_frames
+        if reduced != (self._function in self.reduced_frames):
+            # the frames differ in what they save: call, then return
+            self.write_call(function, num_arguments)
+            self.write_return()
+            return
+
+        self._write_comment(f'call {function} {num_arguments}')
+        self._write_comment('return')
+
+        routine = REDUCED_TAILCALL_ROUTINE if reduced else TAILCALL_ROUTINE
+        instructions = self._pass_argument_count(num_arguments) + [
+            f'@{function}',
+            'D=A',                      # pass the callee
+            f'@{routine}',
+            '0;JMP'                     # let the shared routine move the frame and jump
+        ]
+        self.runtime.add(routine)
+        self.stats['tail calls'] += 1
+
+        self._write_instructions(self._flush_stack() + instructions)
+
+
+    def _count_reduced_frame(self, kind, full_instructions, instructions):
+        self.stats[f'reduced frame {kind}s'] += 1
+        self.stats['reduced frame words saved'] += (
+            self._count_words(full_instructions) - self._count_words(instructions))
+
+
+    @staticmethod
+    def _generate_return_instructions(pointers=FRAME_POINTERS):
         instructions = [
             '@LCL',
             'D=M',
             '@R13',
             'M=D',      # save LCL (end of frame) in temporary variable
-            '@5',
+            f'@{len(pointers) + 1}',
             'A=D-A',
             'D=M',
             '@R14',
@@ -292,32 +955,180 @@ class CodeWriter:
             'D=A+1',
             '@SP',
             'M=D',      # reposition stack pointer for the caller
-            '@R13',
+        ]
+        for pointer in reversed(pointers):
+            instructions += [
+                '@R13',
+                'AM=M-1',
+                'D=M',
+                f'@{pointer}',
+                'M=D',  # restore the segment pointer for the caller
+            ]
+        instructions += [
+            '@R14',
+            'A=M',
+            '0;JMP'     # go to the return address
+        ]
+        return instructions
+
+
+    def write_runtime(self, routines):
+        """Write to the output file,
+        the shared routines of the given names, in a fixed order.
+        """
+        for routine in RUNTIME_ROUTINES:
+            if routine not in routines:
+                continue
+
+            self._write_comment(f'routine {routine}')
+            pointers = FRAME_POINTERS
+            if routine.endswith(REDUCED_FRAME_SUFFIX):
+                pointers = REDUCED_FRAME_POINTERS
+            if routine in (CALL_ROUTINE, REDUCED_CALL_ROUTINE):
+                instructions = self._generate_call_routine(routine, pointers)
+                kind = 'call'
+            elif routine in (RETURN_ROUTINE, REDUCED_RETURN_ROUTINE):
+                instructions = [f'({routine})'] + self._generate_return_instructions(pointers)
+                kind = 'call'
+            elif routine in (TAILCALL_ROUTINE, REDUCED_TAILCALL_ROUTINE):
+                instructions = self._generate_tail_call_routine(routine, pointers)
+                kind = 'tail call'
+            else:
+                command = routine[len(COMPARISON_ROUTINE_PREFIX):]
+                instructions = self._generate_comparison_routine(command)
+                kind = 'comparison'
+
+            self.stats[f'shared {kind} routine words'] += self._count_words(instructions)
+            self._write_instructions(instructions)
+
+
+    @staticmethod
+    def _generate_comparison_routine(command):
+        # expects the return address in R15
+        routine = COMPARISON_ROUTINES[command]
+        return [
+            f'({routine})',
+            '@SP',
             'AM=M-1',
             'D=M',
-            '@THAT',
-            'M=D',      # restore THAT (that segment) for the caller
+            'A=A-1',
+            'D=M-D',
+            'M=-1',     # assume the comparison holds
+            f'@{routine}.TRUE',
+            f'D;J{command.upper()}',
+            '@SP',
+            'A=M-1',
+            'M=0',      # it does not
+            f'({routine}.TRUE)',
+            '@R15',
+            'A=M',
+            '0;JMP'     # go to the return address
+        ]
+
+
+    def _generate_call_routine(self, routine=CALL_ROUTINE, pointers=FRAME_POINTERS):
+        # expects the return address in R13, the number of arguments in R14,
+        # and the callee address in D
+        return [
+            f'({routine})',
+            '@R15',
+            'M=D',                      # save the callee address
             '@R13',
-            'AM=M-1',
             'D=M',
-            '@THIS',
-            'M=D',      # restore THIS (this segment) for the caller
-            '@R13',
-            'AM=M-1',
+            '@SP',
+            'M=M+1',
+            'A=M-1',
+            'M=D',                      # push return address to stack
+            *map(self._push_segment, pointers),
+            '@R14',
             'D=M',
+            f'@{len(pointers) + 1}',
+            'D=D+A',                    # number to subtract from SP to get to ARG
+            '@SP',
+            'D=M-D',
             '@ARG',
-            'M=D',      # restore ARG (argument segment) for the caller
+            'M=D',                      # reposition ARG
+            '@SP',
+            'D=M',
+            '@LCL',
+            'M=D',                      # reposition LCL
+            '@R15',
+            'A=M',
+            '0;JMP'                     # call function (transfer control to callee)
+        ]
+
+
+    @staticmethod
+    def _generate_tail_call_routine(routine=TAILCALL_ROUTINE, pointers=FRAME_POINTERS):
+        # expects the number of arguments in R14, and the callee address in D
+        loop = f'{routine}.LOOP'
+        frame_size = len(pointers) + 1
+        push_frame_word = [
             '@R13',
-            'AM=M-1',
+            'M=M+1',
+            'A=M-1',
             'D=M',
+            '@SP',
+            'M=M+1',
+            'A=M-1',
+            'M=D'
+        ]
+        return [
+            f'({routine})',
+            '@R15',
+            'M=D',                      # save the callee address
             '@LCL',
-            'M=D',      # restore LCL (local segment) for the caller
+            'D=M',
+            f'@{frame_size}',
+            'D=D-A',
+            '@R13',
+            'M=D',                      # R13 = frame saved by the call of the current function
+            *push_frame_word * frame_size,  # push it above the arguments of the callee
+            '@R14',
+            'D=M',
+            f'@{frame_size}',
+            'D=D+A',
+            '@SP',
+            'D=M-D',
+            '@R13',
+            'M=D',                      # R13 = first argument of the callee
+            '@ARG',
+            'D=D-M',
+            '@R14',
+            'M=D',                      # R14 = distance to move the arguments and frame down
+            f'({loop})',
+            '@R13',
+            'D=M',
             '@R14',
+            'D=D-M',
+            '@R13',
             'A=M',
-            '0;JMP'     # go to the return address
+            'D=D+M',
+            'A=D-M',
+            'M=D-A',                    # copy the word at R13 down to R13 - R14
+            '@R13',
+            'MD=M+1',
+            '@SP',
+            'D=D-M',
+            f'@{loop}',
+            'D;JLT',                    # until the whole top of the stack is moved
+            '@R14',
+            'D=M',
+            '@SP',
+            'MD=M-D',                   # reposition SP
+            '@LCL',
+            'M=D',                      # reposition LCL
+            '@R15',
+            'A=M',
+            '0;JMP'                     # jump to the callee, which returns to the caller
         ]
 
-        self._write_instructions(instructions)
+
+    @staticmethod
+    def _count_words(instructions):
+        """Return the number of ROM words taken by the given instructions"""
+        lines = '\n'.join(instructions).split('\n')
+        return sum(1 for line in lines if not line.startswith('('))
 
 
     @staticmethod
@@ -335,19 +1146,6 @@ class CodeWriter:
             'D=M',
             'A=A-1',
         ]
-        equality_operation = [
-            'D=M-D',
-            '@{op}_{unique}',
-            'D;J{op}',
-            'D=0',
-            '@FINALIZE_{unique}',
-            '0;JMP',
-            '({op}_{unique})',
-            'D=-1',
-            '(FINALIZE_{unique})',
-            '@SP',
-            'A=M-1'
-        ]
 
         instruction = []
 
@@ -375,10 +1173,10 @@ class CodeWriter:
 
             # equality operations
             else:
-                # format equality operation snippet
-                instruction.append('\n'.join(equality_operation).format(
-                    op=command.upper(), unique=unique_num)
-                )
+                instruction.append('\n'.join(
+                    CodeWriter._generate_comparison_instructions(command, unique_num)
+                    + ['@SP', 'A=M-1']
+                ))
 
             # set final stack value
             instruction.append('M=D')
@@ -386,59 +1184,21 @@ class CodeWriter:
         return instruction
 
 
-    @staticmethod
-    def _generate_push_pop_snippets(segment, index):
-        # move memory segment register to D
-        seg_to_d = [
-            f'@{index}',
-            'D=A',
-            '@' + ('5' if segment == 'temp' else '{seg}'),
-            'A=D+' + ('A' if segment == 'temp' else 'M'),
-            'D=M'
-        ]
-        # move from D to stack
-        d_to_stack = [
-            '@SP',
-            'M=M+1',
-            'A=M-1',
-            'M=D'
-        ]
-        # move from stack to a temporary memory register
-        stack_to_d = [
-            '@SP',
-            'M=M-1',
-            'A=M',
-            'D=M'
-        ]
-        # move from temporary memory register to memory segment register
-        d_to_seg = [
-            '@R13',  # store value here temporarily
-            'M=D',
-            f'@{index}',
-            'D=A',
-            '@' + ('5' if segment == 'temp' else '{seg}'),
-            'D=D+' + ('A' if segment == 'temp' else 'M'),
-            '@R14',  # store memory segment pointer here
-            'M=D',
-            '@R13',  # where value from stack was stored in
-            'D=M',
-            '@R14',
-            'A=M',   # load memory segment pointer back to A
-            'M=D'
-        ]
-
-        return seg_to_d, d_to_stack, stack_to_d, d_to_seg
-
-
     def _write_comment(self, comment):
-        self.file.write(f'// {comment}\n')
+        if self.comments:
+            self.output.write(f'// {comment}\n')
 
 
     def _write_instructions(self, instructions):
-        self.file.write('\n'.join(instructions) + '\n')
+        self.output.write('\n'.join(instructions) + '\n')
         self.unique_num += 1
 
 
+    def flush(self):
+        """Write all pending code through to the output"""
+        self.output.flush()
+
+
     def close(self):
-        """Close the output file"""
-        self.file.close()
+        """Flush and close the output"""
+        self.output.close()
@@ -10,3 +10,89 @@ C_IF = 'C_IF'
 C_FUNCTION = 'C_FUNCTION'
 C_RETURN = 'C_RETURN'
 C_CALL = 'C_CALL'
+
+# arithmetic-logical commands, in opcode order
+ARITHMETIC_COMMANDS = ('add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not')
+
+# memory segments, in operand order
+SEGMENTS = ('constant', 'local', 'argument', 'this', 'that', 'temp', 'pointer', 'static')
+SEG_CONSTANT = 0
+SEG_LOCAL = 1
+SEG_ARGUMENT = 2
+SEG_THIS = 3
+SEG_THAT = 4
+SEG_TEMP = 5
+SEG_POINTER = 6
+SEG_STATIC = 7
+
+# base address registers of the memory segments located through a pointer
+SEGMENT_POINTERS = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS', 'that': 'THAT'}
+TEMP_BASE = 5
+
+# opcodes of the intermediate representation
+OP_ADD = 0
+OP_SUB = 1
+OP_NEG = 2
+OP_EQ = 3
+OP_GT = 4
+OP_LT = 5
+OP_AND = 6
+OP_OR = 7
+OP_NOT = 8
+OP_PUSH = 9
+OP_POP = 10
+OP_LABEL = 11
+OP_GOTO = 12
+OP_IF = 13
+OP_FUNCTION = 14
+OP_CALL = 15
+OP_RETURN = 16
+OP_TAILCALL = 17  # call followed by return, only created by the optimizer
+
+# command keyword lookup tables
+OPCODES = {command: opcode for opcode, command in enumerate(ARITHMETIC_COMMANDS)}
+OPCODES.update({
+    'push': OP_PUSH,
+    'pop': OP_POP,
+    'label': OP_LABEL,
+    'goto': OP_GOTO,
+    'if-goto': OP_IF,
+    'function': OP_FUNCTION,
+    'call': OP_CALL,
+    'return': OP_RETURN,
+})
+COMMAND_TYPES = dict.fromkeys(ARITHMETIC_COMMANDS, C_ARITHMETIC)
+COMMAND_TYPES.update({
+    'push': C_PUSH,
+    'pop': C_POP,
+    'label': C_LABEL,
+    'goto': C_GOTO,
+    'if-goto': C_IF,
+    'function': C_FUNCTION,
+    'call': C_CALL,
+    'return': C_RETURN,
+})
+SEGMENT_NUMBERS = {segment: number for number, segment in enumerate(SEGMENTS)}
+COMPARISON_COMMANDS = ('eq', 'gt', 'lt')
+
+# segment pointers saved in the frame of each call, and in the reduced frame
+# of a call to a function that neither changes THIS and THAT, nor calls one that might
+FRAME_POINTERS = ('LCL', 'ARG', 'THIS', 'THAT')
+REDUCED_FRAME_POINTERS = ('LCL', 'ARG')
+
+# function the bootstrap code calls
+ENTRY_FUNCTION = 'Sys.init'
+
+# labels of the shared runtime routines, in the order they are linked
+CALL_ROUTINE = '$$call'
+RETURN_ROUTINE = '$$return'
+TAILCALL_ROUTINE = '$$tailcall'
+REDUCED_FRAME_SUFFIX = '.reduced'
+REDUCED_CALL_ROUTINE = CALL_ROUTINE + REDUCED_FRAME_SUFFIX
+REDUCED_RETURN_ROUTINE = RETURN_ROUTINE + REDUCED_FRAME_SUFFIX
+REDUCED_TAILCALL_ROUTINE = TAILCALL_ROUTINE + REDUCED_FRAME_SUFFIX
+COMPARISON_ROUTINE_PREFIX = '$$'
+COMPARISON_ROUTINES = {command: COMPARISON_ROUTINE_PREFIX + command for command in COMPARISON_COMMANDS}
+RUNTIME_ROUTINES = (CALL_ROUTINE, RETURN_ROUTINE, TAILCALL_ROUTINE,
+                    REDUCED_CALL_ROUTINE, REDUCED_RETURN_ROUTINE, REDUCED_TAILCALL_ROUTINE,
+                    *COMPARISON_ROUTINES.values())
@@ -0,0 +1,291 @@
+"""Emulator module of the VM translator
+
+Runs translated programs on an emulated Hack computer,
+to check that a mode of the translator keeps their behaviour:
+
+    python emulator.py <source> [options]
+
+translates the source with the given translator options, and with none,
+runs both programs until they halt, and compares the memory they leave.
+Inlining at -O 2 keeps arguments in the temp slots the program does not use,
+so these differ.
+
+Classes:
+    AssemblyError
+    Emulator
+
+Functions:
+    assemble(str) -> (list, dict)
+    compare(Emulator, Emulator, iterable) -> list
+"""
+
+from errors import TranslationError
+from vm_translator import STREAM_SOURCE, argument_parser, translate_tree, translation_options
+
+
+MAX_CYCLES = 10_000_000  # number of instructions run before a program is deemed not to halt
+RAM_SIZE = 1 << 15
+SCRATCH_BASE = 13  # R13 to R15 are scratch registers of the generated code
+VARIABLE_BASE = 16  # RAM address of the first variable
+HEAP_BASE = 2048
+KEYBOARD = 24576
+
+PREDEFINED_SYMBOLS = {
+    'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+    'SCREEN': 16384, 'KBD': KEYBOARD,
+    **{f'R{register}': register for register in range(16)},
+}
+
+# computations of the ALU, from A, D and M
+COMPUTATIONS = {
+    '0': lambda a, d, m: 0,
+    '1': lambda a, d, m: 1,
+    '-1': lambda a, d, m: -1,
+    'D': lambda a, d, m: d,
+    'A': lambda a, d, m: a,
+    'M': lambda a, d, m: m,
+    '!D': lambda a, d, m: ~d,
+    '!A': lambda a, d, m: ~a,
+    '!M': lambda a, d, m: ~m,
+    '-D': lambda a, d, m: -d,
+    '-A': lambda a, d, m: -a,
+    '-M': lambda a, d, m: -m,
+    'D+1': lambda a, d, m: d + 1,
+    'A+1': lambda a, d, m: a + 1,
+    'M+1': lambda a, d, m: m + 1,
+    'D-1': lambda a, d, m: d - 1,
+    'A-1': lambda a, d, m: a - 1,
+    'M-1': lambda a, d, m: m - 1,
+    'D+A': lambda a, d, m: d + a,
+    'D+M': lambda a, d, m: d + m,
+    'D-A': lambda a, d, m: d - a,
+    'D-M': lambda a, d, m: d - m,
+    'A-D': lambda a, d, m: a - d,
+    'M-D': lambda a, d, m: m - d,
+    'D&A': lambda a, d, m: d & a,
+    'D&M': lambda a, d, m: d & m,
+    'D|A': lambda a, d, m: d | a,
+    'D|M': lambda a, d, m: d | m,
+}
+# commutative computations written the other way around
+COMPUTATIONS.update({
+    'A+D': COMPUTATIONS['D+A'],
+    'M+D': COMPUTATIONS['D+M'],
+    'A&D': COMPUTATIONS['D&A'],
+    'M&D': COMPUTATIONS['D&M'],
+    'A|D': COMPUTATIONS['D|A'],
+    'M|D': COMPUTATIONS['D|M'],
+})
+
+JUMPS = {
+    '': None,
+    'JGT': lambda value: value > 0,
+    'JEQ': lambda value: value == 0,
+    'JGE': lambda value: value >= 0,
+    'JLT': lambda value: value < 0,
+    'JNE': lambda value: value != 0,
+    'JLE': lambda value: value <= 0,
+    'JMP': lambda value: True,
+}
+
+
+class AssemblyError(ValueError):
+    """Raised when an assembly instruction cannot be assembled"""
+
+
+def _word(value):
+    # wrap a value to a signed 16 bit word
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def assemble(code):
+    """Assemble Hack assembly code.
+    Return the program, a list with the value of each A-instruction,
+    and a (computation, dest, jump) tuple for each C-instruction,
+    and a dict mapping each variable to its address.
+    """
+    lines = []
+    for line in code.splitlines():
+        line = line.split('//', 1)[0].strip()
+        if line:
+            lines.append(line)
+
+    # first pass: bind labels to the address of the instruction that follows them
+    symbols = dict(PREDEFINED_SYMBOLS)
+    instructions = []
+    for line in lines:
+        if line.startswith('('):
+            symbols[line[1:-1]] = len(instructions)
+        else:
+            instructions.append(line)
+
+    # second pass: allocate variables in order of first use, and decode instructions
+    program = []
+    variables = {}
+    for instruction in instructions:
+        if instruction.startswith('@'):
+            symbol = instruction[1:]
+            if symbol.isdigit():
+                program.append(int(symbol))
+                continue
+            if symbol not in symbols:
+                symbols[symbol] = variables[symbol] = VARIABLE_BASE + len(variables)
+            program.append(symbols[symbol])
+            continue
+
+        dest, _, computation = instruction.rpartition('=')
+        computation, _, jump = computation.partition(';')
+        if computation not in COMPUTATIONS or jump not in JUMPS or set(dest) - set('AMD'):
+            raise AssemblyError(f'Invalid instruction: {instruction}')
+        program.append((COMPUTATIONS[computation], dest, JUMPS[jump]))
+
+    return program, variables
+
+
+class Emulator:
+    """Emulator of the Hack computer.
+
+    Runs an assembled program, until it halts in a loop jumping to itself,
+    or runs past its last instruction.
+
+    Properties:
+        program: the instructions of the program, as returned by assemble
+        addresses: the address of each variable of the program
+        ram: the data memory
+        cycles: the number of instructions run so far
+
+    Methods:
+        from_code(str) -> Emulator
+        run(int) -> bool
+        variables() -> dict
+    """
+
+    def __init__(self, program, addresses):
+        self.program = program
+        self.addresses = addresses
+        self.ram = [0] * RAM_SIZE
+        self.cycles = 0
+        self._a = self._d = self._pc = 0
+
+
+    @classmethod
+    def from_code(cls, code):
+        """Return an emulator of the given assembly code"""
+        return cls(*assemble(code))
+
+
+    def run(self, max_cycles=MAX_CYCLES):
+        """Run the program until it halts, or for at most the given number of instructions.
+        Returns True if the program halted, else False.
+        """
+        program, ram = self.program, self.ram
+        a, d, pc = self._a, self._d, self._pc
+        cycles, end = self.cycles, self.cycles + max_cycles
+        halted = False
+
+        while cycles < end:
+            if pc >= len(program):
+                halted = True
+                break
+
+            instruction = program[pc]
+            cycles += 1
+            if instruction.__class__ is int:
+                a = instruction
+                pc += 1
+                continue
+
+            computation, dest, jump = instruction
+            address = a & 0x7FFF
+            value = _word(computation(a, d, ram[address]))
+            if 'M' in dest:
+                ram[address] = value
+            if 'D' in dest:
+                d = value
+            if 'A' in dest:
+                a = value
+
+            if jump is None or not jump(value):
+                pc += 1
+            elif address == pc - 1 and program[address] == address and not dest:
+                # jumping back to the instruction loading the jump address, the program can only loop
+                halted = True
+                break
+            else:
+                pc = address
+
+        self._a, self._d, self._pc = a, d, pc
+        self.cycles = cycles
+        return halted
+
+
+    def variables(self):
+        """Return a dict mapping the name of each variable of the program to its value"""
+        return {name: self.ram[address] for name, address in self.addresses.items()}
+
+
+def compare(expected, actual, ignored=()):
+    """Return a list of the differences between the memory left by two programs:
+    in the pointers, the temp segment, the static variables, and the heap.
+    The stack is not compared, as it holds return addresses into the code,
+    nor the variables of one program missing from the other,
+    nor the RAM addresses in ignored.
+    """
+    differences = []
+
+    for address in range(SCRATCH_BASE):
+        if address in ignored:
+            continue
+        if expected.ram[address] != actual.ram[address]:
+            differences.append(f'RAM[{address}]: {expected.ram[address]} != {actual.ram[address]}')
+
+    expected_variables, actual_variables = expected.variables(), actual.variables()
+    for name in sorted(expected_variables.keys() & actual_variables.keys()):
+        if expected_variables[name] != actual_variables[name]:
+            differences.append(f'{name}: {expected_variables[name]} != {actual_variables[name]}')
+
+    for address in range(HEAP_BASE, KEYBOARD):
+        if address in ignored:
+            continue
+        if expected.ram[address] != actual.ram[address]:
+            differences.append(f'RAM[{address}]: {expected.ram[address]} != {actual.ram[address]}')
+
+    return differences
+
+
+def main():
+    arg_parser = argument_parser()
+    arg_parser.usage = 'program [options] <Source>.vm || program [options] <source_dir>'
+    arg_parser.add_argument('--max-cycles', type=int, default=MAX_CYCLES, metavar='N',
+                            help='number of instructions each program may run before it is '
+                                 f'deemed not to halt (default: {MAX_CYCLES})')
+    args = arg_parser.parse_args()
+    if args.source == STREAM_SOURCE or args.build_lib:
+        arg_parser.error('only translated programs can be run')
+    default_args = arg_parser.parse_args([args.source])
+
+    emulators = []
+    try:
+        for options in (translation_options(default_args), translation_options(args)):
+            emulator = Emulator.from_code(translate_tree(args.source, args.jobs, args.lib, **options))
+            if not emulator.run(args.max_cycles):
+                print(f'the program did not halt within {args.max_cycles} instructions')
+                exit(1)
+            emulators.append(emulator)
+    except (TranslationError, AssemblyError) as error:
+        print(error)
+        exit(1)
+
+    expected, actual = emulators
+    differences = compare(expected, actual)
+    for difference in differences:
+        print(difference)
+    print(f'{len(differences)} differences, '
+          f'{expected.cycles} -> {actual.cycles} instructions, '
+          f'{len(expected.program)} -> {len(actual.program)} ROM words')
+    if differences:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""Module for storing the exceptions raised by the VM translator
+
+Classes:
+    TranslationError
+"""
+
+
+class TranslationError(Exception):
+    """Base class of the errors raised when VM code cannot be translated"""
@@ -0,0 +1,105 @@
+"""Superinstruction fusion module of the VM translator
+
+Classes:
+    Fusion
+
+Functions:
+    find_fusions(Program) -> dict
+"""
+
+from constants import *
+
+
+# arithmetic commands computing a value from the two topmost stack values,
+# and the Hack operator computing it
+BINARY_OPERATORS = {OP_ADD: '+', OP_SUB: '-', OP_AND: '&', OP_OR: '|'}
+
+# conditional jump taken when each comparison holds, and when it does not
+COMPARISON_JUMPS = {OP_EQ: 'JEQ', OP_GT: 'JGT', OP_LT: 'JLT'}
+NEGATED_COMPARISON_JUMPS = {OP_EQ: 'JNE', OP_GT: 'JLE', OP_LT: 'JGE'}
+
+
+class Fusion:
+    """A sequence of VM commands translated together, as one superinstruction
+    that keeps intermediate values in registers instead of on the stack.
+
+    Properties:
+        name: name the fusion is written, and reported under
+        opcodes: tuple of the opcodes of the fused commands
+        match: function taking the first and second operands of the commands,
+            and returning whether they can be fused
+        uses_stack: whether the fused code accesses the stack, or only the segments
+    """
+
+    def __init__(self, name, opcodes, match, uses_stack=True):
+        self.name = name
+        self.opcodes = opcodes
+        self.match = match
+        self.uses_stack = uses_stack
+
+
+    def __len__(self):
+        return len(self.opcodes)
+
+
+def _match_binary_move(arg1, arg2):
+    # push a; push b; add|sub|and|or; pop c
+    return arg1[3] != SEG_CONSTANT
+
+
+def _match_move(arg1, arg2):
+    # push a; pop b
+    return arg1[1] != SEG_CONSTANT
+
+
+def _match_constant_operation(arg1, arg2):
+    # push constant n; add|sub|and|or
+    return arg1[0] == SEG_CONSTANT
+
+
+def _match_always(arg1, arg2):
+    return True
+
+
+FUSIONS = [
+    *(Fusion('binary_move', (OP_PUSH, OP_PUSH, opcode, OP_POP), _match_binary_move,
+             uses_stack=False)
+      for opcode in BINARY_OPERATORS),
+    Fusion('move', (OP_PUSH, OP_POP), _match_move, uses_stack=False),
+    *(Fusion('constant_operation', (OP_PUSH, opcode), _match_constant_operation)
+      for opcode in BINARY_OPERATORS),
+    # eq|gt|lt; not; if-goto label
+    *(Fusion('negated_compare_branch', (opcode, OP_NOT, OP_IF), _match_always)
+      for opcode in COMPARISON_JUMPS),
+    # eq|gt|lt; if-goto label
+    *(Fusion('compare_branch', (opcode, OP_IF), _match_always)
+      for opcode in COMPARISON_JUMPS),
+]
+
+
+def find_fusions(program, fusions=FUSIONS):
+    """Return a dict mapping the index of each command starting a fusion,
+    to the Fusion of the commands starting there.
+    Fusions do not overlap, and the first of the given fusions matching
+    at the earliest command is taken.
+    """
+    # fusions that can start with each opcode, tried in order
+    candidates = {}
+    for fusion in fusions:
+        candidates.setdefault(fusion.opcodes[0], []).append(fusion)
+
+    opcodes = program.opcodes
+    found = {}
+    index = 0
+    while index < len(opcodes):
+        for fusion in candidates.get(opcodes[index], ()):
+            end = index + len(fusion)
+            if (tuple(opcodes[index:end]) == fusion.opcodes
+                    and fusion.match(program.arg1[index:end], program.arg2[index:end])):
+                found[index] = fusion
+                index = end
+                break
+        else:
+            index += 1
+
+    return found
@@ -0,0 +1,186 @@
+"""Intermediate representation module of the VM translator
+
+Classes:
+    SymbolTable
+    Program
+"""
+
+from array import array
+
+from constants import *
+
+
+# commands a basic block starts at, as control may enter there from elsewhere
+BLOCK_LEADERS = (OP_LABEL, OP_FUNCTION)
+# commands a basic block ends after, as control may leave from there
+BLOCK_TERMINATORS = (OP_GOTO, OP_IF, OP_RETURN, OP_TAILCALL)
+# commands control never continues after
+UNCONDITIONAL_JUMPS = (OP_GOTO, OP_RETURN, OP_TAILCALL)
+
+
+class SymbolTable:
+    """Interned table of the labels and function names of a program.
+
+    Each distinct name is stored once and referred to by its integer id.
+
+    Properties:
+        names: list of the interned names, indexed by id
+
+    Methods:
+        intern(str) -> int
+    """
+
+    def __init__(self):
+        self.names = []
+        self._ids = {}
+
+
+    def intern(self, name):
+        """Return the id of the given name, adding it to the table if new"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            symbol_id = self._ids[name] = len(self.names)
+            self.names.append(name)
+            return symbol_id
+
+
+    def __getitem__(self, symbol_id):
+        return self.names[symbol_id]
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Program:
+    """Compact intermediate representation of a parsed '.vm' file.
+
+    Commands are stored in parallel arrays, one entry per command:
+    the opcode, and two integer operands whose meaning depends on it.
+
+        arithmetic          -
+        push / pop          segment number, index
+        label / goto / if   label symbol id
+        function / call     function symbol id, number of locals / arguments
+        return              -
+        tail call           function symbol id, number of arguments
+
+    Properties:
+        source: name of the source file the commands came from
+        symbols: SymbolTable of the labels and function names
+        opcodes: array of the command opcodes
+        arg1: array of the first operands
+        arg2: array of the second operands
+        reduced_frames: set of the names of the functions defined or called in the program
+            that neither change THIS and THAT, nor call a function that might,
+            so their frames need not save them
+
+    Methods:
+        append(int, int, int) -> None
+        extend(Program, int, int) -> None
+        functions() -> list
+        basic_blocks() -> list
+        encode() -> bytes
+        format_command(int) -> str
+    """
+
+    def __init__(self, source, symbols=None):
+        self.source = source
+        self.symbols = SymbolTable() if symbols is None else symbols
+        self.opcodes = array('B')
+        self.arg1 = array('i')
+        self.arg2 = array('i')
+        self.reduced_frames = frozenset()
+
+
+    def append(self, opcode, arg1=0, arg2=0):
+        """Append a command to the end of the program"""
+        self.opcodes.append(opcode)
+        self.arg1.append(arg1)
+        self.arg2.append(arg2)
+
+
+    def extend(self, program, start=0, end=None):
+        """Append the commands of another program sharing the same symbol table,
+        from the start index up to the end index.
+        """
+        self.opcodes.extend(program.opcodes[start:end])
+        self.arg1.extend(program.arg1[start:end])
+        self.arg2.extend(program.arg2[start:end])
+
+
+    def functions(self):
+        """Return a list of (name, start, end) of each function defined in the program,
+        where the commands of a function run up to the next function, or the end.
+        """
+        starts = [index for index, opcode in enumerate(self.opcodes) if opcode == OP_FUNCTION]
+        return [(self.symbols[self.arg1[start]], start, end)
+                for start, end in zip(starts, starts[1:] + [len(self)])]
+
+
+    def basic_blocks(self):
+        """Return a list of (start, end) of each basic block of the program:
+        the runs of commands only entered at their first command, at a label or function,
+        and only left after their last, at a jump or return.
+        """
+        blocks = []
+        start = 0
+        for index, opcode in enumerate(self.opcodes):
+            if opcode in BLOCK_LEADERS and index > start:
+                blocks.append((start, index))
+                start = index
+            if opcode in BLOCK_TERMINATORS:
+                blocks.append((start, index + 1))
+                start = index + 1
+        if start < len(self):
+            blocks.append((start, len(self)))
+        return blocks
+
+
+    def encode(self):
+        """Return the commands, and the names they refer to, as bytes"""
+        return b'\0'.join((
+            f'{len(self)}\n'.encode(),
+            self.opcodes.tobytes(),
+            self.arg1.tobytes(),
+            self.arg2.tobytes(),
+            '\n'.join(self.symbols.names).encode(),
+            '\n'.join(sorted(self.reduced_frames)).encode(),
+        ))
+
+
+    def __len__(self):
+        return len(self.opcodes)
+
+
+    def __getitem__(self, index):
+        return self.opcodes[index], self.arg1[index], self.arg2[index]
+
+
+    def __iter__(self):
+        return zip(self.opcodes, self.arg1, self.arg2)
+
+
+    def format_command(self, index):
+        """Return the VM command at the given index in its textual form"""
+        opcode, arg1, arg2 = self[index]
+
+        if opcode <= OP_NOT:
+            return ARITHMETIC_COMMANDS[opcode]
+        if opcode == OP_PUSH or opcode == OP_POP:
+            keyword = 'push' if opcode == OP_PUSH else 'pop'
+            return f'{keyword} {SEGMENTS[arg1]} {arg2}'
+        if opcode == OP_LABEL:
+            return f'label {self.symbols[arg1]}'
+        if opcode == OP_GOTO:
+            return f'goto {self.symbols[arg1]}'
+        if opcode == OP_IF:
+            return f'if-goto {self.symbols[arg1]}'
+        if opcode == OP_FUNCTION:
+            return f'function {self.symbols[arg1]} {arg2}'
+        if opcode == OP_CALL:
+            return f'call {self.symbols[arg1]} {arg2}'
+        if opcode == OP_TAILCALL:
+            return f'tailcall {self.symbols[arg1]} {arg2}'
+        return 'return'
@@ -0,0 +1,78 @@
+"""Library module of the VM translator
+
+Classes:
+    LibraryError
+    Library
+"""
+
+import json
+
+from build_cache import translator_version
+from errors import TranslationError
+from linker import Fragment
+
+
+LIBRARY_FORMAT = 'vmlib'
+
+
+class LibraryError(TranslationError):
+    """Raised when a library archive cannot be used"""
+
+
+class Library:
+    """Precompiled archive of translated '.vm' files.
+
+    Keeps the fragments of a set of source files, such as the Jack OS,
+    so they can be linked into a program without translating them again.
+
+    Properties:
+        fragments: list of the archived fragments
+        exports: dict mapping each exported function name
+            to the name of the fragment defining it
+
+    Methods:
+        save(str) -> None
+        load(str) -> Library
+    """
+
+    def __init__(self, fragments):
+        self.fragments = list(fragments)
+        self.exports = {}
+
+        for fragment in self.fragments:
+            for function in fragment.exports:
+                if function in self.exports:
+                    raise LibraryError(f'Function {function} is defined in both '
+                                       f'{self.exports[function]} and {fragment.name}')
+                self.exports[function] = fragment.name
+
+
+    def save(self, filename):
+        """Write the archive to the given file"""
+        archive = {
+            'format': LIBRARY_FORMAT,
+            'version': translator_version(),
+            'fragments': [fragment.to_dict() for fragment in self.fragments],
+        }
+        with open(filename, 'w') as file:
+            json.dump(archive, file)
+
+
+    @classmethod
+    def load(cls, filename):
+        """Read an archive written by save()"""
+        try:
+            with open(filename, 'r') as file:
+                archive = json.load(file)
+            if archive['format'] != LIBRARY_FORMAT:
+                raise ValueError
+            fragments = [Fragment.from_dict(entry) for entry in archive['fragments']]
+        except (OSError, ValueError, KeyError, TypeError):
+            raise LibraryError(f'Invalid library archive: {filename}') from None
+
+        # fragments are only compatible with the code of the translator that made them
+        if archive.get('version') != translator_version():
+            raise LibraryError(f'Library {filename} was built by another version '
+                               'of the translator, rebuild it')
+
+        return cls(fragments)
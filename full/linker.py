@@ -0,0 +1,99 @@
+"""Linker module of the VM translator
+
+Classes:
+    LinkError
+    Fragment
+
+Functions:
+    resolve(list, list) -> list
+    link(CodeWriter, list) -> None
+"""
+
+from collections import Counter
+
+from errors import TranslationError
+
+
+class LinkError(TranslationError):
+    """Raised when fragments cannot be linked together"""
+
+
+class Fragment:
+    """Relocatable translation of a single '.vm' file.
+
+    The labels generated for a file are scoped to its source name,
+    so fragments translated separately, in any order or process,
+    can be linked together without clashing.
+
+    Properties:
+        name: name of the source file the fragment was translated from
+        text: the translated assembly code
+        exports: names of the functions defined in the fragment
+        requires: names of the shared runtime routines the fragment jumps to
+        stats: Counter of the translation statistics
+
+    Methods:
+        to_dict() -> dict
+        from_dict(dict) -> Fragment
+    """
+
+    def __init__(self, name, text, exports=(), requires=(), stats=None):
+        self.name = name
+        self.text = text
+        self.exports = list(exports)
+        self.requires = list(requires)
+        self.stats = Counter() if stats is None else stats
+
+
+    def to_dict(self):
+        """Return the fragment as a JSON-serializable dict"""
+        return {
+            'name': self.name,
+            'text': self.text,
+            'exports': self.exports,
+            'requires': self.requires,
+            'stats': self.stats,
+        }
+
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Return the fragment stored in a dict created by to_dict()"""
+        return cls(entry['name'], entry['text'], entry['exports'], entry['requires'],
+                   Counter(entry['stats']))
+
+
+def resolve(fragments, libraries):
+    """Return the given fragments, together with the fragments of the libraries.
+    A source file overrides the library fragment translated from the same name.
+    """
+    names = {fragment.name for fragment in fragments}
+    resolved = list(fragments)
+    for library in libraries:
+        resolved += [fragment for fragment in library.fragments if fragment.name not in names]
+        names.update(fragment.name for fragment in library.fragments)
+
+    # every function must be defined exactly once
+    definitions = {}
+    for fragment in resolved:
+        for function in fragment.exports:
+            if function in definitions:
+                raise LinkError(f'Function {function} is defined in both '
+                                f'{definitions[function]} and {fragment.name}')
+            definitions[function] = fragment.name
+
+    return resolved
+
+
+def link(writer, fragments):
+    """Write the given fragments after the code already written by the writer,
+    in a stable order of their source names.
+    The shared runtime routines required by any of them are written first.
+    """
+    routines = set(writer.runtime)
+    for fragment in fragments:
+        routines.update(fragment.requires)
+    writer.write_runtime(routines)
+
+    for fragment in sorted(fragments, key=lambda fragment: fragment.name):
+        writer.write_fragment(fragment.text)
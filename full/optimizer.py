@@ -0,0 +1,573 @@
+"""Optimizer module of the VM translator
+
+Rewrites a parsed Program into an equivalent, smaller one,
+with the passes enabled at the requested optimization level.
+
+Functions:
+    optimize(Program, int, Counter) -> Program
+    fold_constants(Program, Counter) -> Program
+    mark_tail_calls(Program, Counter) -> Program
+    thread_jumps(Program, Counter) -> Program
+    eliminate_dead_functions(list) -> tuple
+    inline_leaf_functions(list, int, dict) -> list
+    elide_frame_saves(list, dict) -> list
+"""
+
+from collections import Counter
+
+from constants import *
+from ir import UNCONDITIONAL_JUMPS, Program
+
+
+# lowest optimization level running the passes over the whole program at once
+WHOLE_PROGRAM_LEVEL = 2
+
+WORD_BITS = 16
+WORD_MASK = (1 << WORD_BITS) - 1
+MAX_CONSTANT = (1 << (WORD_BITS - 1)) - 1  # largest operand of push constant
+
+# value computed by each arithmetic command, on 16-bit two's-complement words
+# comparisons test the sign of the difference, as the generated code does
+BINARY_FOLDS = {
+    OP_ADD: lambda x, y: x + y,
+    OP_SUB: lambda x, y: x - y,
+    OP_AND: lambda x, y: x & y,
+    OP_OR: lambda x, y: x | y,
+    OP_EQ: lambda x, y: -(_word(x - y) == 0),
+    OP_GT: lambda x, y: -(_word(x - y) > 0),
+    OP_LT: lambda x, y: -(_word(x - y) < 0),
+}
+UNARY_FOLDS = {
+    OP_NEG: lambda x: -x,
+    OP_NOT: lambda x: ~x,
+}
+
+# constant operand y for which x <op> y is x
+BINARY_IDENTITIES = {OP_ADD: 0, OP_SUB: 0, OP_OR: 0, OP_AND: -1}
+
+# unary commands undoing themselves when repeated
+INVOLUTIONS = (OP_NEG, OP_NOT)
+
+
+def _word(value):
+    """Return the value wrapped to a signed 16-bit word"""
+    value &= WORD_MASK
+    return value - (1 << WORD_BITS) if value > MAX_CONSTANT else value
+
+
+def _constant_commands(value):
+    """Return the shortest commands pushing the given signed 16-bit word"""
+    if value >= 0:
+        return [(OP_PUSH, SEG_CONSTANT, value)]
+    if value == -MAX_CONSTANT - 1:
+        return [(OP_PUSH, SEG_CONSTANT, MAX_CONSTANT), (OP_NOT, 0, 0)]
+    return [(OP_PUSH, SEG_CONSTANT, -value), (OP_NEG, 0, 0)]
+
+
+def fold_constants(program, stats=None):
+    """Return the program with the arithmetic on constants computed ahead of time,
+    and with the operations leaving their operand unchanged removed.
+
+    Only straight runs of commands are rewritten: a constant pushed
+    before a label is not folded with the commands after it.
+    """
+    stats = Counter() if stats is None else stats
+    commands = []
+    # (start, end, value) of the runs of commands pushing a known constant,
+    # in order, where each run ends where the next one starts, or before
+    constants = []
+
+    def truncate(length):
+        del commands[length:]
+        while constants and constants[-1][1] > length:
+            constants.pop()
+
+    def push_constant(start, value):
+        truncate(start)
+        commands.extend(_constant_commands(value))
+        constants.append((start, len(commands), value))
+
+    for command in program:
+        opcode, arg1, arg2 = command
+        end = len(commands)
+        top = constants[-1] if constants and constants[-1][1] == end else None
+
+        if opcode == OP_PUSH and arg1 == SEG_CONSTANT:
+            push_constant(end, arg2)
+            continue
+
+        if opcode in UNARY_FOLDS and top:
+            start, _, value = top
+            push_constant(start, _word(UNARY_FOLDS[opcode](value)))
+            if len(commands) < end + 1:
+                stats['constant folds'] += 1
+            continue
+
+        if opcode in BINARY_FOLDS and top:
+            below = constants[-2] if len(constants) > 1 and constants[-2][1] == top[0] else None
+            if below:
+                start = below[0]
+                push_constant(start, _word(BINARY_FOLDS[opcode](below[2], top[2])))
+                stats['constant folds'] += 1
+                continue
+            if BINARY_IDENTITIES.get(opcode) == top[2]:
+                truncate(top[0])
+                stats['identity operations removed'] += 1
+                continue
+
+        if opcode in INVOLUTIONS and end and commands[-1][0] == opcode:
+            truncate(end - 1)
+            stats['identity operations removed'] += 1
+            continue
+
+        commands.append(command)
+
+    optimized = Program(program.source, program.symbols)
+    for command in commands:
+        optimized.append(*command)
+    return optimized
+
+
+def _reachable_functions(program):
+    """Return a dict mapping each function defined in the program
+    to the set of the functions of the program its calls may lead to.
+    """
+    calls = {}
+    for name, start, end in program.functions():
+        calls[name] = {program.symbols[program.arg1[index]] for index in range(start, end)
+                       if program.opcodes[index] in (OP_CALL, OP_TAILCALL)}
+
+    reachable = {}
+    for name in calls:
+        reached = set()
+        pending = [name]
+        while pending:
+            for callee in calls.get(pending.pop(), ()):
+                if callee not in reached:
+                    reached.add(callee)
+                    pending.append(callee)
+        reachable[name] = reached
+    return reachable
+
+
+def mark_tail_calls(program, stats=None):
+    """Return the program with each recursive call immediately followed by a return
+    replaced by a tail call, which reuses the frame of the calling function.
+    Only calls that may lead back to the calling function, through the functions
+    of the program, are replaced: they run in constant stack space,
+    while a tail call elsewhere is slower than a call and return.
+    """
+    reachable = _reachable_functions(program)
+    tail_calls = set()
+    for name, start, end in program.functions():
+        for index in range(start, end - 1):
+            if program.opcodes[index] == OP_CALL and program.opcodes[index + 1] == OP_RETURN:
+                # a function reaches itself when it is recursive
+                callee = program.symbols[program.arg1[index]]
+                if name in reachable.get(callee, ()):
+                    tail_calls.add(index)
+
+    marked = Program(program.source, program.symbols)
+    index = 0
+    while index < len(program):
+        opcode, arg1, arg2 = program[index]
+        if index in tail_calls:
+            marked.append(OP_TAILCALL, arg1, arg2)
+            index += 2
+        else:
+            marked.append(opcode, arg1, arg2)
+            index += 1
+    return marked
+
+
+def _jump_targets(program):
+    """Return a dict mapping each label of the program to the label control ends up at
+    when jumping to it, following the labels directly followed by a goto.
+    """
+    opcodes, arg1 = program.opcodes, program.arg1
+    positions = {arg1[index]: index for index, opcode in enumerate(opcodes) if opcode == OP_LABEL}
+
+    def first_command(label):
+        index = positions[label]
+        while index < len(program) and opcodes[index] == OP_LABEL:
+            index += 1
+        return index
+
+    targets = {}
+    for label in positions:
+        target = label
+        seen = {label}
+        while True:
+            index = first_command(target)
+            if (index == len(program) or opcodes[index] != OP_GOTO
+                    or arg1[index] not in positions or arg1[index] in seen):
+                break
+            target = arg1[index]
+            seen.add(target)
+        targets[label] = target
+    return targets
+
+
+def _reachable_blocks(program):
+    """Return the basic blocks of the program control can reach,
+    from the start of the program, or of any function.
+    """
+    blocks = program.basic_blocks()
+    opcodes, arg1 = program.opcodes, program.arg1
+    label_blocks = {arg1[start]: block for block, (start, _) in enumerate(blocks)
+                    if opcodes[start] == OP_LABEL}
+
+    pending = [block for block, (start, _) in enumerate(blocks)
+               if start == 0 or opcodes[start] == OP_FUNCTION]
+    reachable = set(pending)
+    while pending:
+        block = pending.pop()
+        end = blocks[block][1]
+        last = opcodes[end - 1]
+        successors = []
+        if last not in UNCONDITIONAL_JUMPS and block + 1 < len(blocks):
+            successors.append(block + 1)
+        if last == OP_GOTO or last == OP_IF:
+            # jumps to labels defined elsewhere leave the program
+            if arg1[end - 1] in label_blocks:
+                successors.append(label_blocks[arg1[end - 1]])
+        for successor in successors:
+            if successor not in reachable:
+                reachable.add(successor)
+                pending.append(successor)
+    return [blocks[block] for block in sorted(reachable)]
+
+
+def thread_jumps(program, stats=None):
+    """Return the program with jumps to a goto retargeted to where that goto leads,
+    the commands control cannot reach removed, along with gotos to the very next command,
+    and the labels no jump refers to.
+    """
+    stats = Counter() if stats is None else stats
+    changed = True
+    while changed:
+        changed = False
+
+        # thread jumps through chains of gotos
+        targets = _jump_targets(program)
+        threaded = Program(program.source, program.symbols)
+        for opcode, arg1, arg2 in program:
+            if (opcode == OP_GOTO or opcode == OP_IF) and targets.get(arg1, arg1) != arg1:
+                arg1 = targets[arg1]
+                stats['jumps threaded'] += 1
+                changed = True
+            threaded.append(opcode, arg1, arg2)
+
+        # keep the reachable blocks
+        commands = []
+        for start, end in _reachable_blocks(threaded):
+            commands += (threaded[index] for index in range(start, end))
+        if len(commands) < len(threaded):
+            stats['unreachable commands removed'] += len(threaded) - len(commands)
+            changed = True
+
+        # drop gotos to the labels right after them
+        kept = []
+        for index, command in enumerate(commands):
+            if command[0] == OP_GOTO:
+                following = index + 1
+                while (following < len(commands) and commands[following][0] == OP_LABEL
+                       and commands[following][1] != command[1]):
+                    following += 1
+                if following < len(commands) and commands[following][:2] == (OP_LABEL, command[1]):
+                    stats['jumps removed'] += 1
+                    changed = True
+                    continue
+            kept.append(command)
+
+        # drop the labels no jump refers to
+        referenced = {arg1 for opcode, arg1, _ in kept if opcode == OP_GOTO or opcode == OP_IF}
+        program = Program(program.source, program.symbols)
+        for opcode, arg1, arg2 in kept:
+            if opcode == OP_LABEL and arg1 not in referenced:
+                stats['labels removed'] += 1
+                changed = True
+                continue
+            program.append(opcode, arg1, arg2)
+
+    return program
+
+
+# passes only rewriting neighbouring commands, so they can run on any part of a program
+LOCAL_PASSES = [
+    (1, fold_constants),
+]
+
+# passes run at each optimization level and above, in order
+PASSES = LOCAL_PASSES + [
+    (1, mark_tail_calls),
+    (1, thread_jumps),
+]
+
+
+def optimize(program, level, stats=None, passes=PASSES):
+    """Return the program rewritten by the passes enabled at the given optimization level"""
+    for pass_level, optimization_pass in passes:
+        if level >= pass_level:
+            program = optimization_pass(program, stats)
+    return program
+
+
+def eliminate_dead_functions(programs, entry=ENTRY_FUNCTION):
+    """Return the programs without the functions that no chain of calls
+    from the entry function reaches, and a dict mapping the name of each
+    removed function to a Program of its commands.
+    Without an entry function, the programs are returned unchanged.
+    """
+    # functions, and the functions each calls
+    functions = {}
+    calls = {}
+    for program in programs:
+        for name, start, end in program.functions():
+            functions[name] = program, start, end
+            calls[name] = {program.symbols[program.arg1[index]] for index in range(start, end)
+                           if program.opcodes[index] in (OP_CALL, OP_TAILCALL)}
+    if entry not in functions:
+        return programs, {}
+
+    live = {entry}
+    pending = [entry]
+    while pending:
+        for callee in calls[pending.pop()]:
+            # calls to functions defined elsewhere are left to the linker
+            if callee in functions and callee not in live:
+                live.add(callee)
+                pending.append(callee)
+
+    live_programs = []
+    dead = {}
+    for program in programs:
+        live_program = Program(program.source, program.symbols)
+        # commands before the first function are kept
+        ranges = program.functions()
+        live_program.extend(program, 0, ranges[0][1] if ranges else None)
+        for name, start, end in ranges:
+            if name in live:
+                live_program.extend(program, start, end)
+            else:
+                dead[name] = Program(program.source, program.symbols)
+                dead[name].extend(program, start, end)
+        live_programs.append(live_program)
+    return live_programs, dead
+
+
+# largest body of a leaf function inlined at its call sites, in commands
+INLINE_MAX_COMMANDS = 16
+# default number of commands inlining may add to the whole program
+INLINE_BUDGET = 1024
+TEMP_SLOTS = 8
+
+# change in stack depth caused by each command inside a function body
+STACK_EFFECTS = {
+    **dict.fromkeys((OP_ADD, OP_SUB, OP_EQ, OP_GT, OP_LT, OP_AND, OP_OR, OP_POP, OP_IF), -1),
+    **dict.fromkeys((OP_NEG, OP_NOT, OP_LABEL, OP_GOTO), 0),
+    OP_PUSH: 1,
+}
+
+
+def _returns_one_value(program, start, end):
+    """Return whether the commands from start to end, entered with an empty stack,
+    only jump to their own labels, never pop below where they started,
+    and leave exactly one value on the stack at each return.
+    """
+    depth = 0
+    label_depths = {}
+    labels = set()
+    for index in range(start, end):
+        opcode, arg1 = program.opcodes[index], program.arg1[index]
+        if opcode == OP_LABEL:
+            labels.add(arg1)
+            known = label_depths.setdefault(arg1, depth)
+            if depth is None:
+                depth = known
+            if depth is None or known != depth:
+                # reached only by jumps back, or at different depths
+                return False
+            continue
+        if depth is None:
+            # unreachable
+            continue
+        if opcode == OP_RETURN:
+            if depth != 1:
+                return False
+            depth = None
+            continue
+
+        depth += STACK_EFFECTS[opcode]
+        if depth < 0:
+            return False
+        if opcode == OP_GOTO or opcode == OP_IF:
+            if label_depths.setdefault(arg1, depth) != depth:
+                return False
+            if opcode == OP_GOTO:
+                depth = None
+
+    return depth is None and labels.issuperset(label_depths)
+
+
+def _leaf_functions(programs):
+    """Return a dict mapping the name of each function small enough to inline,
+    that calls no other, to (program, start, end) of its commands.
+    """
+    leaves = {}
+    for program in programs:
+        for name, start, end in program.functions():
+            if (end - start - 1 <= INLINE_MAX_COMMANDS
+                    and OP_CALL not in program.opcodes[start:end]
+                    and OP_TAILCALL not in program.opcodes[start:end]
+                    and _returns_one_value(program, start + 1, end)):
+                leaves[name] = program, start, end
+    return leaves
+
+
+def _inline_commands(caller, function, leaf, arguments, free_slots, site):
+    """Return the commands executing the body of a leaf function in place of a call to it,
+    with its arguments, locals, and the pointers it changes kept in the free temp slots,
+    or None if it cannot be inlined there.
+    """
+    program, start, end = leaf
+    locals_count = program.arg2[start]
+    body = range(start + 1, end)
+    # largest index accessed in each segment
+    indexes = {}
+    for index in body:
+        if program.opcodes[index] in (OP_PUSH, OP_POP):
+            segment = program.arg1[index]
+            indexes[segment] = max(indexes.get(segment, 0), program.arg2[index])
+    pointers = sorted({program.arg2[index] for index in body
+                       if program.opcodes[index] == OP_POP and program.arg1[index] == SEG_POINTER})
+
+    # statics are named after the file the commands are translated in
+    if SEG_STATIC in indexes and program.source != caller.source:
+        return None
+    if indexes.get(SEG_ARGUMENT, -1) >= arguments or indexes.get(SEG_LOCAL, -1) >= locals_count:
+        return None
+    if arguments + locals_count + len(pointers) > len(free_slots):
+        return None
+
+    slots = iter(free_slots)
+    argument_slots = [next(slots) for _ in range(arguments)]
+    local_slots = [next(slots) for _ in range(locals_count)]
+    pointer_slots = {pointer: next(slots) for pointer in pointers}
+    remapped = {SEG_ARGUMENT: argument_slots, SEG_LOCAL: local_slots}
+
+    def label(symbol_id):
+        return caller.symbols.intern(f'{function}$inline.{site}${program.symbols[symbol_id]}')
+    end_label = caller.symbols.intern(f'{function}$inline.{site}')
+
+    commands = [(OP_POP, SEG_TEMP, slot) for slot in reversed(argument_slots)]
+    for slot in local_slots:
+        commands += [(OP_PUSH, SEG_CONSTANT, 0), (OP_POP, SEG_TEMP, slot)]
+    for pointer, slot in pointer_slots.items():
+        commands += [(OP_PUSH, SEG_POINTER, pointer), (OP_POP, SEG_TEMP, slot)]
+
+    jumps_to_end = False
+    for index in body:
+        opcode, arg1, arg2 = program[index]
+        if opcode in (OP_PUSH, OP_POP) and arg1 in remapped:
+            commands.append((opcode, SEG_TEMP, remapped[arg1][arg2]))
+        elif opcode in (OP_LABEL, OP_GOTO, OP_IF):
+            commands.append((opcode, label(arg1), 0))
+        elif opcode == OP_RETURN:
+            if index < end - 1:
+                commands.append((OP_GOTO, end_label, 0))
+                jumps_to_end = True
+        else:
+            commands.append((opcode, arg1, arg2))
+
+    if jumps_to_end:
+        commands.append((OP_LABEL, end_label, 0))
+    for pointer, slot in pointer_slots.items():
+        commands += [(OP_PUSH, SEG_TEMP, slot), (OP_POP, SEG_POINTER, pointer)]
+    return commands
+
+
+def inline_leaf_functions(programs, budget=INLINE_BUDGET, stats=None):
+    """Return the programs with calls to small functions that call no other
+    replaced by the commands of their body, adding at most the budget of commands.
+
+    The arguments and locals of an inlined body live in the temp slots
+    no command of the programs uses, so the body cannot clobber its caller,
+    and the pointers it changes are restored after it, as a return would.
+    stats maps the source names to the Counters the inlined calls are counted in.
+    """
+    used_slots = {arg2 for program in programs for opcode, arg1, arg2 in program
+                  if opcode in (OP_PUSH, OP_POP) and arg1 == SEG_TEMP}
+    free_slots = [slot for slot in range(TEMP_SLOTS) if slot not in used_slots]
+    leaves = _leaf_functions(programs)
+    if not leaves or not free_slots:
+        return programs
+
+    inlined_programs = []
+    site = 0
+    for program in programs:
+        inlined = Program(program.source, program.symbols)
+        for command in program:
+            opcode, arg1, arg2 = command
+            function = program.symbols[arg1] if opcode in (OP_CALL, OP_TAILCALL) else None
+            if function in leaves:
+                commands = _inline_commands(program, function, leaves[function], arg2,
+                                            free_slots, site)
+                if commands is not None and opcode == OP_TAILCALL:
+                    commands.append((OP_RETURN, 0, 0))
+                if commands is not None and len(commands) - 1 <= budget:
+                    budget -= len(commands) - 1
+                    site += 1
+                    for inlined_command in commands:
+                        inlined.append(*inlined_command)
+                    if stats is not None:
+                        stats[program.source]['inlined calls'] += 1
+                        stats[program.source]['inlined commands'] += len(commands)
+                    continue
+            inlined.append(*command)
+        inlined_programs.append(inlined)
+    return inlined_programs
+
+
+def elide_frame_saves(programs, stats=None):
+    """Return the programs with the functions that neither change THIS and THAT,
+    nor call a function that might, in the reduced_frames of the programs
+    defining or calling them: calls to them need not save and restore THIS and THAT.
+
+    The entry function, entered from the bootstrap code with a full frame,
+    and callers of functions defined elsewhere, are assumed to change them.
+    stats maps the source names to the Counters the reduced functions are counted in.
+    """
+    callers = {}
+    defined = set()
+    changing = {ENTRY_FUNCTION}
+    for program in programs:
+        for name, start, end in program.functions():
+            defined.add(name)
+            for index in range(start, end):
+                opcode, arg1, arg2 = program[index]
+                if opcode == OP_POP and arg1 == SEG_POINTER:
+                    changing.add(name)
+                elif opcode == OP_CALL or opcode == OP_TAILCALL:
+                    callers.setdefault(program.symbols[arg1], set()).add(name)
+
+    # functions defined elsewhere might change them
+    changing.update(callee for callee in callers if callee not in defined)
+
+    # so do the callers of a function that changes them
+    pending = list(changing)
+    while pending:
+        for caller in callers.get(pending.pop(), ()):
+            if caller not in changing:
+                changing.add(caller)
+                pending.append(caller)
+    reduced = defined - changing
+
+    for program in programs:
+        functions = {name for name, _, _ in program.functions()}
+        called = {program.symbols[arg1] for opcode, arg1, _ in program
+                  if opcode == OP_CALL or opcode == OP_TAILCALL}
+        program.reduced_frames = frozenset(reduced & (functions | called))
+        if stats is not None:
+            stats[program.source]['reduced frame functions'] += len(reduced & functions)
+    return programs
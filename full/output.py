@@ -0,0 +1,84 @@
+"""Output module of the VM translator
+
+Classes:
+    BufferedOutput
+    MemoryOutput
+"""
+
+
+class BufferedOutput:
+    """Output backend of the Hack VM Translator.
+
+    Collects assembly fragments in memory,
+    and writes them to the underlying stream in large chunks.
+
+    Properties:
+        stream: writable text stream the fragments are flushed to
+        chunk_size: number of buffered characters that triggers a flush
+
+    Methods:
+        write(str) -> None
+        flush() -> None
+        close() -> None
+    """
+
+    def __init__(self, stream, chunk_size=1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._fragments = []
+        self._size = 0
+
+
+    def write(self, fragment):
+        """Buffer a fragment, flushing the buffer once it is large enough"""
+        self._fragments.append(fragment)
+        self._size += len(fragment)
+        if self._size >= self.chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        """Write all buffered fragments to the stream"""
+        self.stream.writelines(self._fragments)
+        self._fragments.clear()
+        self._size = 0
+
+
+    def close(self):
+        """Flush the buffer and close the stream"""
+        self.flush()
+        self.stream.close()
+
+
+class MemoryOutput:
+    """In-memory output backend of the Hack VM Translator.
+
+    Collects assembly fragments to be retrieved as a single string.
+
+    Methods:
+        write(str) -> None
+        flush() -> None
+        close() -> None
+        getvalue() -> str
+    """
+
+    def __init__(self):
+        self._fragments = []
+
+
+    def write(self, fragment):
+        """Collect a fragment"""
+        self._fragments.append(fragment)
+
+
+    def flush(self):
+        """Do nothing, the fragments are kept in memory"""
+
+
+    def close(self):
+        """Do nothing, the fragments are kept in memory"""
+
+
+    def getvalue(self):
+        """Return all collected fragments joined together"""
+        return ''.join(self._fragments)
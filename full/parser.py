@@ -1,107 +1,165 @@
 """Parser module of the VM translator
 
 Classes:
+    ParseError
     Parser
 """
 
+import re
+from itertools import islice
+
 from constants import *
+from errors import TranslationError
+from ir import Program
+
+
+COMMENT = re.compile(r'//.*')
+
+
+class ParseError(TranslationError, ValueError):
+    """Raised when a VM command cannot be parsed"""
+
 
 class Parser:
     """Parser class of Hack VM Translator.
 
-    Handles the parsing of a single '.vm' file:
+    Handles the parsing of a single '.vm' file, or a stream of VM code lines:
 
     Provides services for reading a VM command,
     unpacking the command into its various components,
     and providing convenient access to them.
 
+    A file is read and tokenized up front, a stream is tokenized line by line;
+    iterating over the parser yields the remaining commands pre-split.
+
     Properties:
-        file: file object containing the source VM code
+        strict: whether unknown commands are rejected instead of skipped
         current_command: the VM command currently being processed
+        fields: the fields of the current command
 
     Methods:
+        from_text(str, bool) -> Parser
+        tokenize(str) -> iterator
         advance() -> bool
+        parse(str, SymbolTable, int) -> Program
         command_type() -> str
         arg1() -> str
         arg2() -> int
     """
 
-    def __init__(self, filename):
-        self.file = open(filename, 'r')
-        self.current_command = ''
+    def __init__(self, source, strict=False):
+        self.strict = strict
+        self.fields = []
+
+        if isinstance(source, str):
+            with open(source, 'r') as file:
+                self._commands = self.tokenize(file.read())
+        else:
+            # any other iterable of lines is tokenized lazily, as the lines arrive
+            self._commands = filter(None, (line.split('//', 1)[0].split() for line in source))
 
 
-    def __del__(self):
-        self.file.close()
+    @classmethod
+    def from_text(cls, text, strict=False):
+        """Return a parser of the VM code in the given string"""
+        parser = cls((), strict)
+        parser._commands = cls.tokenize(text)
+        return parser
+
+
+    @staticmethod
+    def tokenize(source):
+        """Return an iterator over the commands in the given VM source,
+        each split into its fields. Comments and blank lines are skipped.
+        """
+        # strip all comments at once, then split lines and fields in bulk
+        if '//' in source:
+            source = COMMENT.sub('', source)
+        return filter(None, map(str.split, source.splitlines()))
+
+
+    def __iter__(self):
+        """Iterate over the remaining commands,
+        making each one the current command in turn.
+        """
+        for self.fields in self._commands:
+            yield self.fields
+
+
+    @property
+    def current_command(self):
+        """The VM command currently being processed"""
+        return ' '.join(self.fields)
 
 
     def advance(self):
         """Advance to the next command, and makes it the current command.
         Returns True if a command was found, else False.
         """
-        self.current_command = ''
-
-        while char := self.file.read(1):
-            #ignore whitespace
-            if char == ' ':
-                if not self.current_command:
-                    continue
-            # ignore comments
-            elif char == '/':
-                if self.current_command:
-                    self._format_cmd()
-                    return True
-                self.file.readline()
-                continue
-            # check for end of command
-            elif char == '\n':
-                if self.current_command:
-                    self._format_cmd()
-                    return True
-                continue
+        fields = next(self._commands, None)
+        if fields is None:
+            return False
+
+        self.fields = fields
+        return True
 
-            self.current_command += char
 
-        return False
+    def parse(self, source, symbols=None, limit=None):
+        """Lower the remaining commands into a Program,
+        the compact intermediate representation consumed by the code writer.
+        Labels and function names are interned into the given symbol table.
+        If a limit is given, lower at most that many commands,
+        so the program is only empty once all the commands are read.
+        """
+        program = Program(source, symbols)
+        if limit is None:
+            self._lower(program, self)
+        else:
+            # skipped commands don't count towards the limit, read as many more instead
+            while limit := self._lower(program, islice(self, limit)):
+                pass
+        return program
+
+
+    def _lower(self, program, commands):
+        """Append the given commands to the program.
+        Return the number of unknown commands skipped.
+        """
+        append = program.append
+        intern = program.symbols.intern
+        skipped = 0
+
+        for fields in commands:
+            opcode = OPCODES.get(fields[0])
+            if opcode is None:
+                if self.strict:
+                    raise ParseError(f'Unknown command: {self.current_command}')
+                skipped += 1
+                continue
 
+            try:
+                if opcode <= OP_NOT or opcode == OP_RETURN:
+                    append(opcode)
+                elif opcode <= OP_POP:
+                    append(opcode, SEGMENT_NUMBERS[fields[1]], int(fields[2]))
+                elif opcode <= OP_IF:
+                    append(opcode, intern(fields[1]))
+                else:  # function and call
+                    append(opcode, intern(fields[1]), int(fields[2]))
+            except (IndexError, KeyError, ValueError):
+                raise ParseError(f'Invalid command: {self.current_command}') from None
 
-    def _format_cmd(self):
-        for i in range(len(self.current_command) - 1, 0, -1):
-            if self.current_command[i] != ' ':
-                return
-            # remove following whitespace
-            self.current_command = self.current_command[0:i]
+        return skipped
 
 
     def command_type(self):
-        """Returns a the type of the current command"""
-
-        # check for arithmetic commands
-        arithmetic_cmds = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not']
-        if self.current_command in arithmetic_cmds:
-            return C_ARITHMETIC
-
-        # check for stack operation commands
-        if self.current_command.startswith('push'):
-            return C_PUSH
-        if self.current_command.startswith('pop'):
-            return C_POP
-
-        # check for branching commands
-        if self.current_command.startswith('label'):
-            return C_LABEL
-        if self.current_command.startswith('goto'):
-            return C_GOTO
-        if self.current_command.startswith('if-goto'):
-            return C_IF
-
-        # check for function commands
-        if self.current_command.startswith('function'):
-            return C_FUNCTION
-        if self.current_command.startswith('call'):
-            return C_CALL
-        if self.current_command.startswith('return'):
-            return C_RETURN
+        """Returns a the type of the current command.
+        Unknown commands return None, or raise ParseError in strict mode.
+        """
+        cmd_type = COMMAND_TYPES.get(self.fields[0])
+        if cmd_type is None and self.strict:
+            raise ParseError(f'Unknown command: {self.current_command}')
+        return cmd_type
 
 
     def arg1(self):
@@ -110,28 +168,9 @@ class Parser:
         """
         if self.command_type() == C_ARITHMETIC:
             return self.current_command
-        return self._get_cmd_field(2)
+        return self.fields[1]
 
 
     def arg2(self):
         """Return the second argument of the current command"""
-        return int(self._get_cmd_field(3))
-
-
-    def _get_cmd_field(self, field_num):
-        field_str = ''
-
-        current_field = 0
-        inside_field = False
-
-        for char in self.current_command:
-            if not inside_field and char != ' ':
-                current_field += 1
-                inside_field = True
-            elif inside_field and char == ' ':
-                inside_field = False
-
-            if inside_field and current_field == field_num:
-                field_str += char
-
-        return field_str
+        return int(self.fields[2])
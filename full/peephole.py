@@ -0,0 +1,197 @@
+"""Peephole optimizer module of the VM translator
+
+Classes:
+    Rule
+    PeepholeOptimizer
+
+Rules:
+    push_pop, redundant_address, increment_decrement, repeated_instruction
+"""
+
+import re
+from collections import Counter
+
+
+# instructions are matched starting with the newline before them, and ending before the newline after them.
+# comment lines are transparent to the rules: they may appear between any matched instructions
+SEPARATOR = r'\n(?://[^\n]*\n)*'
+COMMENT = re.compile(r'\n//[^\n]*')
+
+# C-instruction storing its result without writing A, nor jumping
+NO_ADDRESS_WRITE = r'[MD]{{1,2}}=[^\n;]*'
+
+
+class Rule:
+    """A rewrite rule of the peephole optimizer.
+
+    Each rule rewrites a short run of instructions into a run
+    that leaves A, D, and the RAM in exactly the same state.
+    The pattern of a rule never matches labels, nor jumps,
+    so it only ever rewrites straight-line code, and cannot change
+    where control flows or what state it arrives in.
+
+    Properties:
+        name: name the rule's hits are counted under
+        pattern: regular expression matching the instructions to rewrite,
+            from the newline before them to the end of the last one,
+            where {sep} matches the newline, and any comment lines,
+            between two instructions, and {window} is the maximum number
+            of other instructions looked at
+        rewrite: function taking the match of the pattern,
+            and returning its replacement, or None to leave it as is
+    """
+
+    def __init__(self, name, pattern, rewrite):
+        self.name = name
+        self.pattern = pattern
+        self.rewrite = rewrite
+
+
+def _comments(match):
+    """Return the comment lines of a match, which are kept before its replacement"""
+    return ''.join(COMMENT.findall(match.group(0)))
+
+
+def _rewrite_push_pop(match):
+    # pushing D and popping it right back only leaves D in the top stack slot
+    return _comments(match) + '\n@SP\nA=M\nM=D'
+
+
+def _rewrite_redundant_address(match):
+    # loading an address A already holds: @X, <instructions not writing A>, @X
+    return match.group(0)[:-len(match.group(1)) - 1]
+
+
+def _rewrite_increment_decrement(match):
+    # incrementing and decrementing the same register cancel out
+    return _comments(match)
+
+
+def _rewrite_repeated_instruction(match):
+    # repeating an instruction that does not write its own operands,
+    # nor A, has no further effect: ex. M=D, M=D or D=M, D=M
+    dest, comp = match.group('dest'), match.group('comp')
+    if any(register in comp for register in dest):
+        return None
+    return f'\n{dest}={comp}' + _comments(match)
+
+
+RULES = [
+    Rule('push_pop',
+         r'\n@SP{sep}M=M\+1{sep}A=M-1{sep}M=D{sep}@SP{sep}(?:M=M-1{sep}A=M|AM=M-1){sep}D=M(?=\n)',
+         _rewrite_push_pop),
+    Rule('redundant_address',
+         r'\n(@[^\n]+)(?:{sep}' + NO_ADDRESS_WRITE + r'){{0,{window}}}{sep}\1(?=\n)',
+         _rewrite_redundant_address),
+    Rule('increment_decrement',
+         r'\n(?P<register>[MD])=(?P=register)(?P<sign>[+-])1{sep}'
+         r'(?P=register)=(?P=register)(?!(?P=sign))[+-]1(?=\n)',
+         _rewrite_increment_decrement),
+    Rule('repeated_instruction',
+         r'\n(?P<dest>M|D|MD|DM)=(?P<comp>[^\n;]*){sep}(?P=dest)=(?P=comp)(?=\n)',
+         _rewrite_repeated_instruction),
+]
+
+
+class PeepholeOptimizer:
+    """Peephole optimizer of the Hack VM Translator.
+
+    An output backend wrapping another backend: rewrites the assembly code
+    written through it with a library of rules, then passes it on.
+
+    Code is buffered, and rewritten a chunk at a time, up to the last label
+    or jump, as no rule matches across them. Straight-line code longer
+    than a chunk keeps its last instructions for the next chunk.
+
+    Properties:
+        output: the output backend the optimized code is written to
+        window: maximum number of instructions a rule looks at
+        rules: list of the Rules applied
+        stats: Counter of the number of times each rule was applied
+        chunk_size: number of characters buffered before they are rewritten
+
+    Methods:
+        write(str) -> None
+        flush() -> None
+        close() -> None
+    """
+
+    def __init__(self, output, window=32, rules=RULES, stats=None, chunk_size=1 << 16):
+        self.output = output
+        self.window = window
+        self.rules = rules
+        self.stats = Counter() if stats is None else stats
+        self.chunk_size = chunk_size
+        self._patterns = [
+            re.compile(rule.pattern.format(sep=SEPARATOR, window=max(window - 2, 0)))
+            for rule in rules
+        ]
+        self._pending = []
+        self._pending_size = 0
+
+
+    def write(self, fragment):
+        """Buffer a fragment of assembly code, to be optimized and written on"""
+        self._pending.append(fragment)
+        self._pending_size += len(fragment)
+        if self._pending_size >= self.chunk_size:
+            self._write_pending(final=False)
+
+
+    def flush(self):
+        """Optimize and write on all buffered code, then flush the output"""
+        self._write_pending(final=True)
+        self.output.flush()
+
+
+    def close(self):
+        """Flush, and close the output"""
+        self.flush()
+        self.output.close()
+
+
+    def _write_pending(self, final):
+        text = ''.join(self._pending)
+        split = len(text) if final else self._split(text)
+        self.output.write(self._optimize(text[:split]))
+        self._pending = [text[split:]]
+        self._pending_size = len(text) - split
+
+
+    def _split(self, text):
+        # split the code after the last label or jump,
+        # or before the last instructions of straight-line code
+        barrier = max(text.rfind('\n('), text.rfind(';'))
+        if barrier >= 0:
+            return text.find('\n', barrier + 1) + 1
+
+        split = len(text)
+        for _ in range(self.window + 1):
+            split = text.rfind('\n', 0, split - 1) + 1
+            if not split:
+                break
+        return split
+
+
+    def _optimize(self, text):
+        # apply the rules until none matches
+        text = '\n' + text
+        changed = True
+        while changed:
+            changed = False
+            for rule, pattern in zip(self.rules, self._patterns):
+                hits = 0
+
+                def replace(match):
+                    nonlocal hits
+                    replacement = rule.rewrite(match)
+                    if replacement is None:
+                        return match.group(0)
+                    hits += 1
+                    return replacement
+
+                text = pattern.sub(replace, text)
+                if hits:
+                    self.stats[f'peephole {rule.name}'] += hits
+                    changed = True
+        return text[1:]
@@ -0,0 +1,143 @@
+"""Regression module of the VM translator
+
+Translates each program of the regression directory in every mode of MODES,
+runs it on the emulator, and compares the memory it leaves,
+the instructions it runs and its size with the default translation:
+
+    python regression.py [program ...]
+
+A mode fails when a program does not halt, leaves other values in memory,
+or takes more instructions or ROM words than the default translation
+where the mode bounds them.
+
+Functions:
+    free_temp_addresses(str) -> set
+    check_program(str, list) -> list
+"""
+
+import argparse
+import os
+
+from constants import *
+from emulator import AssemblyError, Emulator, compare
+from errors import TranslationError
+from vm_translator import (argument_parser, find_source_files, parse_file,
+                           translate_tree, translation_options)
+
+
+REGRESSION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regression')
+TEMP_SIZE = 8
+MAX_SHOWN = 4  # number of the problems of a mode printed
+
+# translator arguments of each mode, and the measures it may not increase:
+# shared code trades instructions for ROM words, and tail calls at -O 1
+# trade them for constant stack space in recursions
+MODES = [
+    (['--no-comments'], ('cycles', 'words')),
+    (['--shared-calls'], ('words',)),
+    (['--comparisons', 'shared'], ('words',)),
+    (['--comparisons', 'auto'], ('words',)),
+    (['--peephole'], ('cycles', 'words')),
+    (['--fusion'], ('cycles', 'words')),
+    (['--tos-cache'], ('cycles', 'words')),
+    (['--virtual-sp'], ('cycles', 'words')),
+    (['--tos-cache', '--virtual-sp'], ('cycles', 'words')),
+    (['--prologue-threshold', '0'], ()),
+    (['-O', '1'], ('words',)),
+    (['-O', '2'], ('cycles', 'words')),
+    (['-O', '2', '--inline-budget', '8'], ('cycles', 'words')),
+    (['-j', '2'], ('cycles', 'words')),
+    (['-O', '1', '--shared-calls', '--virtual-sp'], ('words',)),
+    (['-O', '2', '--shared-calls', '--comparisons', 'auto', '--peephole', '--fusion',
+      '--tos-cache', '--virtual-sp', '--no-comments'], ('cycles', 'words')),
+]
+
+
+def free_temp_addresses(path):
+    """Return the RAM addresses of the temp slots
+    the '.vm' files of the given source never push or pop.
+    Inlining at -O 2 keeps arguments there, so their values may differ.
+    """
+    addresses = set(range(TEMP_BASE, TEMP_BASE + TEMP_SIZE))
+    for source_file in find_source_files(path)[0]:
+        program = parse_file(source_file, {})
+        for opcode, segment, index in zip(program.opcodes, program.arg1, program.arg2):
+            if opcode in (OP_PUSH, OP_POP) and segment == SEG_TEMP:
+                addresses.discard(TEMP_BASE + index)
+    return addresses
+
+
+def run(path, arguments):
+    # translate the source in the mode of the given arguments, and run it until it halts
+    args = argument_parser().parse_args([path] + arguments)
+    code = translate_tree(path, args.jobs, args.lib, **translation_options(args))
+    emulator = Emulator.from_code(code)
+    if not emulator.run():
+        raise AssemblyError('the program did not halt')
+    return emulator
+
+
+def check_program(path, modes):
+    """Check the given source in each of the given modes.
+    Return the list of the failures, and print a line per mode.
+    """
+    failures = []
+    name = os.path.basename(path)
+    ignored = free_temp_addresses(path)
+    expected = run(path, [])
+    print(f'{name}: {expected.cycles} instructions, {len(expected.program)} ROM words')
+
+    for arguments, bounded in modes:
+        mode = ' '.join(arguments)
+        try:
+            actual = run(path, arguments)
+        except (TranslationError, AssemblyError) as error:
+            failures.append(f'{name} {mode}: {error}')
+            print(f'    {mode}: {error}')
+            continue
+
+        problems = compare(expected, actual, ignored)
+        measures = {
+            'cycles': (expected.cycles, actual.cycles),
+            'words': (len(expected.program), len(actual.program)),
+        }
+        for measure in bounded:
+            default, value = measures[measure]
+            if value > default:
+                problems.append(f'{measure} {default} -> {value}')
+
+        failures.extend(f'{name} {mode}: {problem}' for problem in problems)
+        shown = problems[:MAX_SHOWN]
+        if len(problems) > MAX_SHOWN:
+            shown.append(f'{len(problems) - MAX_SHOWN} more')
+        print(f'    {mode}: {actual.cycles} instructions, {len(actual.program)} ROM words'
+              + ''.join(f', {problem}' for problem in shown))
+
+    return failures
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        usage='program [<source_dir> ...]',
+        description='check every translation mode on the emulator, against the default one')
+    arg_parser.add_argument('programs', nargs='*', metavar='source_dir',
+                            help=f'programs to check (default: those in {REGRESSION_DIR})')
+    args = arg_parser.parse_args()
+    programs = args.programs or sorted(file.path for file in os.scandir(REGRESSION_DIR)
+                                       if file.is_dir())
+
+    failures = []
+    for path in programs:
+        try:
+            failures.extend(check_program(path, MODES))
+        except (TranslationError, AssemblyError) as error:
+            failures.append(f'{path}: {error}')
+            print(f'{path}: {error}')
+
+    print(f'{len(failures)} failures in {len(programs)} programs and {len(MODES)} modes')
+    if failures:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
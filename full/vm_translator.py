@@ -1,90 +1,501 @@
-"""Main module of the VM translator"""
+"""Main module of the VM translator
 
+Can also be imported to translate VM code in-process.
+Every function translates with fresh state,
+and reports errors by raising a TranslationError.
+
+Functions:
+    translate_source(str, str) -> str
+    translate_tree(str) -> str
+    translate_stream(iterable, stream) -> None
+    build_library(str, str) -> None
+"""
+
+import argparse
 import os
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-from parser import Parser
+from parser import ParseError, Parser
+from build_cache import CACHE_DIR, BuildCache
 from code_writer import CodeWriter
 from constants import *
+from errors import TranslationError
+from ir import Program
+from library import Library
+from linker import Fragment, link, resolve
+from optimizer import (INLINE_BUDGET, LOCAL_PASSES, WHOLE_PROGRAM_LEVEL, elide_frame_saves,
+                       eliminate_dead_functions, inline_leaf_functions, optimize)
+from output import BufferedOutput, MemoryOutput
 
 
 SOURCE_EXT = 'vm'
 TARGET_EXT = 'asm'
+STREAM_SOURCE = '-'
+STREAM_NAME = 'Stream'
+STREAM_BATCH = 256  # number of commands translated at a time when streaming
+PEEPHOLE_WINDOW = 32
+PROLOGUE_THRESHOLD = 8
 
 
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: program <Source>.vm || program <source_dir>')
+    arg_parser = argument_parser()
+    args = arg_parser.parse_args()
+
+    source = args.source
+    options = translation_options(args)
+
+    # stream from stdin to stdout
+    if source == STREAM_SOURCE:
+        if args.lib or args.build_lib or args.cache or args.cache_dir:
+            arg_parser.error('libraries and the build cache cannot be used when streaming')
+        try:
+            translate_stream(sys.stdin, sys.stdout, **options)
+        except TranslationError as error:
+            print(error, file=sys.stderr)
+            exit(1)
+        return
+
+    try:
+        # determine source and target files according to user input
+        source_files, target_file = find_source_files(source)
+
+        # reuse the fragments of unchanged source files from the build cache
+        cache = None
+        if args.cache or args.cache_dir:
+            cache_dir = args.cache_dir or os.path.join(os.path.dirname(target_file), CACHE_DIR)
+            cache = BuildCache(cache_dir, options)
+
+        whole_program = not (args.build_lib or args.lib)
+        fragments = translate_files(source_files, options, args.jobs, cache, whole_program)
+
+        if args.build_lib:
+            Library(fragments).save(args.build_lib)
+        else:
+            libraries = [Library.load(filename) for filename in args.lib]
+            fragments = resolve(fragments, libraries)
+
+            # create code writer instance for the target, and link the fragments after its bootstrap code
+            writer = CodeWriter(target_file, **writer_options(options))
+            link(writer, fragments)
+
+            # close target file
+            writer.close()
+    except TranslationError as error:
+        print(error)
         exit(1)
 
-    source = sys.argv[1]
-    is_dir = os.path.isdir(source)
+    if cache:
+        print(f'build cache: {cache.hits} hits, {cache.misses} misses')
+    if args.stats or args.fusion_report:
+        stats = sum((fragment.stats for fragment in fragments), Counter())
+        if not args.build_lib:
+            stats += writer.stats
+        if args.stats:
+            print_stats(stats)
+        if args.fusion_report:
+            print_fusion_report(stats)
+
+
+def print_stats(stats):
+    hits, misses = stats['template cache hits'], stats['template cache misses']
+    hit_rate = hits / (hits + misses) * 100 if hits + misses else 0
+    print(f'template cache: {hits} hits, {misses} misses ({hit_rate:.1f}% hit rate)')
+
+    if stats['shared call sites'] or stats['shared return sites']:
+        routine_words = stats['shared call routine words']
+        saved = stats['shared call words saved'] - routine_words
+        print(f"shared calls: {stats['shared call sites']} call sites, "
+              f"{stats['shared return sites']} return sites, {saved} ROM words saved "
+              f"(including {routine_words} words of shared routines)")
+    if stats['shared comparison sites']:
+        routine_words = stats['shared comparison routine words']
+        saved = stats['shared comparison words saved'] - routine_words
+        print(f"shared comparisons: {stats['shared comparison sites']} sites, "
+              f"{saved} ROM words saved (including {routine_words} words of shared routines)")
+    if stats['prologues']:
+        print(f"function prologues: {stats['prologues']} functions with local variables, "
+              f"{stats['prologue words saved']} ROM words saved")
+    if stats['constant folds'] or stats['identity operations removed']:
+        print(f"optimizer: {stats['constant folds']} constant folds, "
+              f"{stats['identity operations removed']} identity operations removed")
+    if any(stats[name] for name in ('jumps threaded', 'jumps removed',
+                                    'unreachable commands removed', 'labels removed')):
+        print(f"control flow: {stats['jumps threaded']} jumps threaded, "
+              f"{stats['jumps removed']} jumps to the next command removed, "
+              f"{stats['unreachable commands removed']} unreachable commands removed, "
+              f"{stats['labels removed']} unused labels removed")
+    if stats['tail calls']:
+        print(f"tail calls: {stats['tail calls']} sites, "
+              f"{stats['shared tail call routine words']} words of shared routine")
+    if stats['reduced frame functions']:
+        print(f"reduced frames: {stats['reduced frame functions']} functions, "
+              f"{stats['reduced frame calls']} call sites, "
+              f"{stats['reduced frame returns']} return sites, "
+              f"{stats['reduced frame words saved']} ROM words saved")
+    if stats['inlined calls']:
+        caller_words = stats['inlined caller words'] - stats['inlining caller words']
+        print(f"inlining: {stats['inlined calls']} calls inlined, "
+              f"{stats['inlined commands']} commands in their place, "
+              f"callers {caller_words:+} ROM words, "
+              f"{stats['uncalled inlined function words']} ROM words saved by removing "
+              f"{stats['uncalled inlined functions']} functions left uncalled")
+    dead = {name.split(' ', 2)[2]: words for name, words in sorted(stats.items())
+            if name.startswith('dead function ')}
+    if dead:
+        print(f'dead functions: {len(dead)} removed, {sum(dead.values())} ROM words saved')
+        for name, words in dead.items():
+            print(f'  {name}: {words} words')
+    peephole = {name.split(' ', 1)[1]: hits for name, hits in sorted(stats.items())
+                if name.startswith('peephole ')}
+    if peephole:
+        print('peephole: ' + ', '.join(f'{name} {hits}' for name, hits in peephole.items()))
+
+
+def print_fusion_report(stats):
+    fusions = {name.split(' ', 1)[1]: count for name, count in stats.items()
+               if name.startswith('fusion ')}
+    print(f'fused sequences: {sum(fusions.values())}')
+    for name, count in sorted(fusions.items(), key=lambda item: (-item[1], item[0])):
+        print(f'  {name}: {count}')
+
+
+def argument_parser():
+    """Return the parser of the command line arguments of the translator"""
+    arg_parser = argparse.ArgumentParser(
+        usage='program [options] <Source>.vm || program [options] <source_dir> '
+              f'|| program [options] {STREAM_SOURCE}')
+    arg_parser.add_argument('source', help="a '.vm' file or a directory of '.vm' files, "
+                                           f"or '{STREAM_SOURCE}' to translate stdin to stdout")
+    arg_parser.add_argument('--strict', action='store_true',
+                            help='reject unknown commands instead of skipping them')
+    arg_parser.add_argument('-O', dest='optimization', type=int, choices=(0, 1, 2), default=0,
+                            metavar='LEVEL',
+                            help='optimize the parsed commands before translating them: '
+                                 '1 folds constants, removes identity operations, '
+                                 'turns recursive calls followed by a return into jumps, '
+                                 'threads jumps to jumps, and removes unreachable commands '
+                                 'and unused labels, '
+                                 '2 also, unless libraries are linked, inlines small functions '
+                                 'calling no other, removes the functions Sys.init never calls, '
+                                 'and calls functions that never change THIS and THAT '
+                                 'without saving them (default: 0)')
+    arg_parser.add_argument('--inline-budget', type=int, default=INLINE_BUDGET, metavar='N',
+                            help='number of VM commands inlining at -O 2 may add to the program, '
+                                 'as an estimate of the ROM words they translate to '
+                                 f'(default: {INLINE_BUDGET})')
+    arg_parser.add_argument('--no-comments', dest='comments', action='store_false',
+                            help='omit the comment preceding each command')
+    arg_parser.add_argument('--shared-calls', action='store_true',
+                            help='jump to shared call and return routines, '
+                                 'instead of inlining them at every site')
+    arg_parser.add_argument('--comparisons', choices=('inline', 'shared', 'auto'), default='inline',
+                            help="jump to shared eq, gt, and lt routines, or let 'auto' "
+                                 'pick whichever is smaller for each program (default: inline)')
+    arg_parser.add_argument('--peephole', action='store_true',
+                            help='rewrite the generated assembly with a peephole optimizer')
+    arg_parser.add_argument('--peephole-window', type=int, default=PEEPHOLE_WINDOW, metavar='N',
+                            help='number of instructions the peephole optimizer looks at once '
+                                 f'(default: {PEEPHOLE_WINDOW})')
+    arg_parser.add_argument('--fusion', action='store_true',
+                            help='translate common sequences of commands together, '
+                                 'keeping intermediate values off the stack')
+    arg_parser.add_argument('--fusion-report', action='store_true',
+                            help='print how often each sequence was fused (implies --fusion)')
+    arg_parser.add_argument('--tos-cache', action='store_true',
+                            help='keep the topmost stack value in the D register '
+                                 'within straight-line code')
+    arg_parser.add_argument('--virtual-sp', action='store_true',
+                            help='address the stack relative to SP within straight-line code, '
+                                 'updating SP once before branching, calling, or returning')
+    arg_parser.add_argument('--prologue-threshold', type=int, default=PROLOGUE_THRESHOLD, metavar='N',
+                            help='zero the local variables of functions with more than N of them '
+                                 f'in a loop, instead of one by one (default: {PROLOGUE_THRESHOLD})')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                            help='translate the source files in N parallel processes')
+    arg_parser.add_argument('--lib', action='append', default=[], metavar='LIB',
+                            help='link the precompiled library archive LIB into the output')
+    arg_parser.add_argument('--build-lib', metavar='LIB',
+                            help='precompile the source into the library archive LIB '
+                                 'instead of translating it')
+    arg_parser.add_argument('--cache', action='store_true',
+                            help=f"reuse the translations of unchanged files, cached in '{CACHE_DIR}'")
+    arg_parser.add_argument('--cache-dir', metavar='DIR',
+                            help='cache the translations in DIR (implies --cache)')
+    arg_parser.add_argument('--stats', action='store_true',
+                            help='print translation statistics')
+    return arg_parser
+
+
+def translation_options(args):
+    """Return the options that affect the translated code"""
+    return {
+        'comments': args.comments,
+        'strict': args.strict,
+        'optimization': args.optimization,
+        'inline_budget': args.inline_budget,
+        'shared_calls': args.shared_calls,
+        'comparisons': args.comparisons,
+        'peephole': args.peephole_window if args.peephole else 0,
+        'fusion': args.fusion or args.fusion_report,
+        'tos_cache': args.tos_cache,
+        'virtual_sp': args.virtual_sp,
+        'prologue_threshold': args.prologue_threshold,
+    }
 
-    # determine source and target files according to user input
-    if is_dir:
+
+def writer_options(options):
+    """Return the translation options that are passed to the code writer"""
+    return {name: value for name, value in options.items()
+            if name not in ('strict', 'optimization', 'inline_budget')}
+
+
+def translate_source(text, name='Main', strict=False, optimization=0, **options):
+    """Translate the VM code in a string, as if read from the file '<name>.vm'.
+    Return the assembly code, starting with the bootstrap code.
+    """
+    program = optimize(Parser.from_text(text, strict).parse(name), optimization)
+    if optimization >= WHOLE_PROGRAM_LEVEL:
+        program = optimize_programs([program], options)[0][0]
+    fragment = translate_program(program, options)
+
+    output = MemoryOutput()
+    writer = CodeWriter(output, **writer_options(options))
+    link(writer, [fragment])
+    writer.flush()
+    return output.getvalue()
+
+
+def translate_tree(path, jobs=1, libraries=(), **options):
+    """Translate a '.vm' file, or a directory of '.vm' files,
+    linked with the library archives of the given filenames.
+    Return the assembly code, starting with the bootstrap code.
+    """
+    source_files = find_source_files(path)[0]
+    fragments = translate_files(source_files, options, jobs, whole_program=not libraries)
+    fragments = resolve(fragments, [Library.load(filename) for filename in libraries])
+
+    output = MemoryOutput()
+    writer = CodeWriter(output, **writer_options(options))
+    link(writer, fragments)
+    writer.flush()
+    return output.getvalue()
+
+
+def build_library(path, filename, jobs=1, **options):
+    """Precompile a '.vm' file, or a directory of '.vm' files,
+    into a library archive with the given filename.
+    """
+    fragments = translate_files(find_source_files(path)[0], options, jobs)
+    Library(fragments).save(filename)
+
+
+def translate_stream(lines, stream, strict=False, optimization=0, **options):
+    """Translate VM code read from an iterable of lines,
+    into assembly code written to a writable text stream.
+
+    Commands are translated in small batches as the lines arrive,
+    so memory use stays bounded however long the input is.
+    Static variables and labels are named after the class of each function.
+    A batch may jump to labels of another, so only the passes rewriting
+    neighbouring commands optimize it.
+    """
+    writer = CodeWriter(BufferedOutput(stream), class_sources=True, **writer_options(options))
+    writer.set_filename(STREAM_NAME)
+    parser = Parser(lines, strict=strict)
+
+    while program := parser.parse(writer.source, limit=STREAM_BATCH):
+        writer.write_program(optimize(program, optimization, writer.stats, LOCAL_PASSES))
+        writer.flush()
+
+    writer.write_runtime(writer.runtime)
+    writer.flush()
+
+
+def find_source_files(source):
+    """Return the '.vm' files to translate for the given source file or directory,
+    and the '.asm' file their translation is written to.
+    """
+    if os.path.isdir(source):
         # get all files with the extension '.vm' in the specified source directory
-        source_files = [file.path for file in os.scandir(source)
-                        if file.path.split('.')[-1] == SOURCE_EXT]
+        source_files = sorted(file.path for file in os.scandir(source)
+                              if file.path.split('.')[-1] == SOURCE_EXT)
         absolute_path = os.path.abspath(source)
         target_file = f'{absolute_path}/{os.path.basename(absolute_path)}.{TARGET_EXT}'
-    else:
+    elif os.path.isfile(source):
         source_files = [source]
         target_file = parse_filename(source)[0] + f'.{TARGET_EXT}'
-
-    # create code writer instance for the target
-    writer = CodeWriter(target_file)
+    else:
+        raise TranslationError(f'No such file or directory: {source}')
 
     for source_file in source_files:
         filename, ext = parse_filename(source_file)
-        
+
         # check if filename and extension is valid
         if not (filename or filename[0].isupper() or ext != SOURCE_EXT):
-              print(f'Invalid filename format: {filename}.{ext}')
-              exit(1)
-
-        # create parser instance for each source file
-        parser = Parser(source_file)
-
-        translate(filename, parser, writer)
-
-    # close target file
-    writer.close()
-
-
-def translate(source, parser, writer):
-    writer.set_filename(source)
-    
-    while parser.advance():
-        cmd_type = parser.command_type()
-
-        # arithmetic and logical commands
-        if cmd_type == C_ARITHMETIC:
-            writer.write_arithmetic(parser.current_command)
-        
-        # memory access commands
-        elif cmd_type == C_PUSH or cmd_type == C_POP:
-            writer.write_push_pop(cmd_type, parser.arg1(), parser.arg2())
-        
-        # branching commands
-        elif cmd_type == C_LABEL:
-            writer.write_label(parser.arg1())
-        elif cmd_type == C_GOTO:
-            writer.write_goto(parser.arg1())
-        elif cmd_type == C_IF:
-            writer.write_if(parser.arg1())
-
-        # function commands
-        elif cmd_type == C_FUNCTION:
-            writer.write_function(parser.arg1(), parser.arg2())
-        elif cmd_type == C_CALL:
-            writer.write_call(parser.arg1(), parser.arg2())
-        elif cmd_type == C_RETURN:
-            writer.write_return()
+              raise TranslationError(f'Invalid filename format: {filename}.{ext}')
+
+    return source_files, target_file
+
+
+def translate_files(source_files, options, jobs=1, cache=None, whole_program=False):
+    """Translate each source file into a fragment, in parallel if requested.
+    Fragments found in the cache are not translated again.
+
+    When the files make up the whole program, and the optimization level
+    enables whole-program passes, all of them are parsed and optimized together
+    before any is translated, and fragments are cached by their optimized commands
+    instead of the content of their source file.
+    """
+    if whole_program and options.get('optimization', 0) >= WHOLE_PROGRAM_LEVEL:
+        stats = {}
+        programs = []
+        for source_file in source_files:
+            program_stats = Counter()
+            programs.append(parse_file(source_file, options, program_stats))
+            stats[programs[-1].source] = program_stats
+        programs, pass_stats = optimize_programs(programs, options)
+        for source, program_stats in pass_stats.items():
+            stats[source] += program_stats
+
+        fragments = translate_units(programs, translate_program, options, jobs, cache,
+                                    lambda program: (program.source, program.encode()))
+        for fragment, program in zip(fragments, programs):
+            fragment.stats += stats[program.source]
+        return fragments
+
+    def source_key(source_file):
+        with open(source_file, 'rb') as file:
+            return parse_filename(source_file)[0], file.read()
+
+    return translate_units(source_files, translate_file, options, jobs, cache, source_key)
+
+
+def translate_units(units, translate_unit, options, jobs=1, cache=None, unit_key=None):
+    """Translate each unit into a fragment with the given function, in parallel if requested.
+    Fragments found in the cache, under the key of the source name and content
+    unit_key returns for each unit, are not translated again.
+    """
+    fragments = {}
+    keys = {}
+
+    if cache:
+        for index, unit in enumerate(units):
+            keys[index] = key = cache.key(*unit_key(unit))
+            fragment = cache.load(key)
+            if fragment:
+                fragments[index] = fragment
+
+    missing = [index for index in range(len(units)) if index not in fragments]
+    if jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            translated = list(pool.map(translate_unit, [units[index] for index in missing],
+                                       repeat(options)))
+    else:
+        translated = [translate_unit(units[index], options) for index in missing]
+
+    for index, fragment in zip(missing, translated):
+        fragments[index] = fragment
+        if cache:
+            cache.store(keys[index], fragment)
+
+    return [fragments[index] for index in range(len(units))]
+
+
+def translate_file(source_file, options):
+    """Translate a single '.vm' file into a relocatable fragment"""
+    stats = Counter()
+    program = parse_file(source_file, options, stats)
+    fragment = translate_program(program, options)
+    fragment.stats += stats
+    return fragment
+
+
+def parse_file(source_file, options, stats=None):
+    """Parse a single '.vm' file into a Program, optimized at the level of the options"""
+    filename = parse_filename(source_file)[0]
+    try:
+        program = Parser(source_file, strict=options.get('strict', False)).parse(filename)
+    except ParseError as error:
+        raise ParseError(f'{source_file}: {error}') from None
+    return optimize(program, options.get('optimization', 0), stats)
+
+
+def translate_program(program, options):
+    """Translate a Program into a relocatable fragment"""
+    output = MemoryOutput()
+    writer = CodeWriter(output, bootstrap=False, **writer_options(options))
+    writer.set_filename(program.source)
+    writer.write_program(program)
+    writer.flush()
+
+    exports = [program.symbols[arg1] for opcode, arg1, _ in program if opcode == OP_FUNCTION]
+    stats = writer.stats + Counter({
+        'template cache hits': writer.template_cache.hits,
+        'template cache misses': writer.template_cache.misses,
+    })
+    return Fragment(writer.source, output.getvalue(), exports, sorted(writer.runtime), stats)
+
+
+def optimize_programs(programs, options):
+    """Return the programs of the whole program rewritten by the whole-program passes,
+    and a dict mapping source names to the Counter of the statistics of their passes.
+    """
+    stats = {program.source: Counter() for program in programs}
+
+    programs, dead = eliminate_dead_functions(programs)
+    for function, program in dead.items():
+        stats[program.source][f'dead function {function}'] = count_program_words(program, options)
+
+    inlined = inline_leaf_functions(programs, options.get('inline_budget', INLINE_BUDGET), stats)
+    # size of the callers, with the calls, then with the inlined bodies
+    for program, inlined_program in zip(programs, inlined):
+        for function, inlined_function in zip(split_functions(program), split_functions(inlined_program)):
+            if list(inlined_function) != list(function):
+                stats[program.source]['inlining caller words'] += count_program_words(function, options)
+                stats[program.source]['inlined caller words'] += count_program_words(inlined_function,
+                                                                                      options)
+
+    # functions only called where they were inlined
+    programs, uncalled = eliminate_dead_functions(inlined)
+    for program in uncalled.values():
+        stats[program.source]['uncalled inlined functions'] += 1
+        stats[program.source]['uncalled inlined function words'] += count_program_words(program, options)
+
+    programs = elide_frame_saves(programs, stats)
+    return programs, stats
+
+
+def split_functions(program):
+    """Return a list of Programs of the commands before the first function
+    of the program, then of each of its functions.
+    """
+    ranges = program.functions()
+    starts = [0] + [start for _, start, _ in ranges]
+    ends = [start for _, start, _ in ranges] + [len(program)]
+    parts = []
+    for start, end in zip(starts, ends):
+        part = Program(program.source, program.symbols)
+        part.extend(program, start, end)
+        parts.append(part)
+    return parts
+
+
+def count_program_words(program, options):
+    """Return the number of ROM words the given Program translates to"""
+    return count_words(translate_program(program, options).text)
+
+
+def count_words(text):
+    """Return the number of ROM words taken by the given assembly code"""
+    return sum(1 for line in text.splitlines() if line and line[0] not in '/(')
 
 
 def parse_filename(file):
     split_filename = file.split('.')
-    
+
     filename = ''.join(split_filename[0:-1])
     ext = split_filename[-1]
 